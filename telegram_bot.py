@@ -3,21 +3,50 @@
 from __future__ import unicode_literals
 
 import telegram
-from telegram.ext import Updater, CommandHandler, ConversationHandler, MessageHandler, CallbackQueryHandler, Filters
+from telegram.ext import Updater, Dispatcher, CallbackContext, CommandHandler, ConversationHandler, MessageHandler, CallbackQueryHandler, TypeHandler, Filters, PicklePersistence
 from telegram.error import TelegramError, Unauthorized
 import logging
+import logging.handlers
 
 import os
 import sys
 import traceback
-from threading import Thread
+from threading import Thread, RLock
 import shutil
 import pickle
+import shelve
+import dbm
+import time
+import tempfile
+import argparse
+import copy
+import queue
+import atexit
+import heapq
+import bisect
+import random
 import datetime
-from collections import defaultdict
+import json
+import math
+import signal
+import struct
+import zlib
+import types
+from collections import defaultdict, OrderedDict
+from collections.abc import MutableMapping
 
 from functools import wraps
 
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
 with open("api_key.txt", 'r') as f:
     TOKEN = f.read().rstrip()
 
@@ -28,32 +57,508 @@ ADMIN = [539621524]
 
 TITLE, DESCRIPTION, REWARD = range(3)
 
-def setup_logger(name, log_file, level=logging.INFO):
-    formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-    handler = logging.FileHandler(log_file)
-    handler.setFormatter(formatter)
+DATABASE_PATH = "./sidequestdatabase"
+DATABASE_BACKUP_PATH = "./sidequestdatabasebackup"
+# Held by whichever process has the database loaded to save over it: the bot or a command line import.
+INSTANCE_LOCK_PATH = "./sidequestdatabase.lock"
+# Bump this whenever a migrator is registered (see init_database).
+SCHEMA_VERSION = 7
+
+ARCHIVE_DIRECTORY = "./archives"
+ARCHIVES_PAGE_SIZE = 5
+# Fields are cut down to these lengths on the archive pages so a whole page always fits in one message:
+# 5 * (300 + 3 * 120 + labels) stays under Telegram's 4096 characters.
+ARCHIVE_PREVIEW_LENGTH = 300
+ARCHIVE_FIELD_PREVIEW_LENGTH = 120
+
+BOARD_STORE_PATH = "./boardstore"
+# Boards nobody has looked at for this long are moved out of memory when the database is saved.
+BOARD_IDLE_SECONDS = 24 * 3600
+
+EXPORT_DIRECTORY = "./exports"
+
+UPDATE_LOG_PATH = "./update_log.jsonl"
+# Start the bot with --record to log every incoming update so it can be replayed later.
+RECORD_UPDATES = "--record" in sys.argv
+
+# How often to archive sidequests that are past their deadline.
+EXPIRY_CHECK_SECONDS = 60
+# How often to drop the drafts of new sidequests whose editor was abandoned.
+DRAFT_PURGE_SECONDS = 3600
+# An editor that has been open this long is treated as abandoned.
+EDITOR_TIMEOUT_SECONDS = 24 * 3600
+# Deadlines can be at most this far away.
+DEADLINE_MAX_HOURS = 365 * 24
+
+# Sidequest editor conversations and user_data are kept here. Writes are held in memory and only
+# flushed to disk alongside the database, so an editor resumes where it was after a restart.
+CONVERSATION_STATE_PATH = "./conversationstate"
+
+# Telegram allows about 30 messages a second in total, so batched notifications are sent a bit slower than that.
+NOTIFICATION_INTERVAL = 1.0 / 25
+# How long stopping or restarting the bot waits for queued notifications to go out.
+NOTIFICATION_DRAIN_SECONDS = 30
+
+# How often the leaderboard counters are checked against the boards themselves.
+RECONCILE_SECONDS = 6 * 3600
+LEADERBOARD_DEFAULT_SIZE = 10
+LEADERBOARD_MAX_SIZE = 50
+
+# Start the bot with --debug to check the database invariants touched by every update and job.
+DEBUG_INVARIANTS = "--debug" in sys.argv
+
+# The namespace for everyone who joined in a DM, which is also where every user from before namespaces went.
+GLOBAL_NAMESPACE = 0
+
+LOG_MAX_BYTES = 10 * 1024 * 1024
+LOG_BACKUP_COUNT = 5
+
+class JsonFormatter(logging.Formatter):
+    # Writes each record as one JSON object per line. Extra fields can be attached with extra={"fields": {...}}.
+
+    def format(self, record):
+        entry = {"time": datetime.datetime.fromtimestamp(record.created).isoformat(),
+                 "logger": record.name,
+                 "level": record.levelname,
+                 "message": record.getMessage()}
+        entry.update(getattr(record, "fields", {}))
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+LOG_LISTENERS = []
+
+
+def setup_logger(name, log_file, level=logging.INFO, formatter=None, max_bytes=LOG_MAX_BYTES, when=None):
+    # Records are put on a queue and written out by a background listener thread, so handlers never wait on disk I/O.
+    # Files rotate by size, or by time if when is given (see TimedRotatingFileHandler).
+    if when is not None:
+        handler = logging.handlers.TimedRotatingFileHandler(log_file, when=when, encoding="utf-8")
+    else:
+        handler = logging.handlers.RotatingFileHandler(log_file, maxBytes=max_bytes, backupCount=LOG_BACKUP_COUNT, encoding="utf-8")
+    handler.setFormatter(formatter if formatter is not None else JsonFormatter())
+
+    log_queue = queue.Queue(-1)
+    listener = logging.handlers.QueueListener(log_queue, handler)
+    listener.start()
+    LOG_LISTENERS.append(listener)
 
     logger = logging.getLogger(name)
     logger.setLevel(level)
-    logger.addHandler(handler)
+    logger.addHandler(logging.handlers.QueueHandler(log_queue))
+    logger.propagate = False
 
     return logger
 
+
+def stop_loggers():
+    # Drains whatever is still queued before the process exits.
+    for listener in LOG_LISTENERS:
+        listener.stop()
+    del LOG_LISTENERS[:]
+
+
+atexit.register(stop_loggers)
+
 ERROR_LOGGER = setup_logger("error_logger", "error_logs.log")
+JOB_LOGGER = setup_logger("job_logger", "job_logs.log")
+# Feedback is kept forever, so it's split into a new file every week instead of being rotated away.
+FEEDBACK_LOGGER = setup_logger("feedback_logger", "feedback.jsonl", when="W0")
+
+
+class BoardStore(MutableMapping):
+    # Maps telegram_id -> sidequest board. Recently used boards are kept in memory in LRU order and
+    # idle ones are moved to a shelf on disk by evict_idle(), then faulted back in on their next access.
+    # Like the defaultdict(list) it replaces, looking up a missing board creates an empty one.
+
+    def __init__(self, path, boards=None):
+        self.path = path
+        self.lock = RLock()
+        self.shelf = shelve.open(path)
+        self.resident = OrderedDict()
+        self.last_access = {}
+
+        now = time.time()
+        for telegram_id, board in (boards or {}).items():
+            self.resident[telegram_id] = board
+            self.last_access[telegram_id] = now
+
+    def __getstate__(self):
+        # Only the resident boards go into the database snapshot; the rest already live in the shelf.
+        with self.lock:
+            return {"path": self.path, "boards": dict(self.resident)}
+
+    def __setstate__(self, state):
+        self.__init__(state["path"], state["boards"])
+
+    def __getitem__(self, telegram_id):
+        with self.lock:
+            board = self.resident.get(telegram_id)
+            if board is None:
+                board = self.shelf.get(str(telegram_id), [])
+                self.resident[telegram_id] = board
+            self.resident.move_to_end(telegram_id)
+            self.last_access[telegram_id] = time.time()
+            return board
+
+    def peek(self, telegram_id):
+        # Read-only access for scans over every board, so they don't pull cold boards into memory.
+        with self.lock:
+            board = self.resident.get(telegram_id)
+            if board is not None:
+                return board
+            return self.shelf.get(str(telegram_id), [])
+
+    def __setitem__(self, telegram_id, board):
+        with self.lock:
+            self.resident[telegram_id] = board
+            self.resident.move_to_end(telegram_id)
+            self.last_access[telegram_id] = time.time()
+
+    def __delitem__(self, telegram_id):
+        with self.lock:
+            found = False
+            if telegram_id in self.resident:
+                del self.resident[telegram_id]
+                del self.last_access[telegram_id]
+                found = True
+            if str(telegram_id) in self.shelf:
+                del self.shelf[str(telegram_id)]
+                found = True
+            if not found:
+                raise KeyError(telegram_id)
+
+    def __contains__(self, telegram_id):
+        with self.lock:
+            return telegram_id in self.resident or str(telegram_id) in self.shelf
+
+    def __iter__(self):
+        with self.lock:
+            keys = list(self.resident)
+            keys.extend(int(key) for key in self.shelf.keys() if int(key) not in self.resident)
+        return iter(keys)
+
+    def __len__(self):
+        return len(list(iter(self)))
+
+    def extend_cold(self, telegram_id, quests):
+        # Appends to a board without making it resident, so bulk imports run in constant memory.
+        with self.lock:
+            if telegram_id in self.resident:
+                self.resident[telegram_id].extend(quests)
+            else:
+                board = self.shelf.get(str(telegram_id), [])
+                board.extend(quests)
+                self.shelf[str(telegram_id)] = board
+
+    def evict_idle(self, idle_seconds):
+        with self.lock:
+            cutoff = time.time() - idle_seconds
+            # The resident boards are in LRU order, so stop at the first recently used one.
+            while len(self.resident) > 0:
+                telegram_id, board = next(iter(self.resident.items()))
+                if self.last_access[telegram_id] >= cutoff:
+                    break
+                self.shelf[str(telegram_id)] = board
+                del self.resident[telegram_id]
+                del self.last_access[telegram_id]
+            self.shelf.sync()
 
 """
 Contains:
 
-sidequests - Key is telegram_id, value is a list as [sidequest title, sidequest description, sidequest reward, list of accepters by Telegram ID].
+sidequests - A BoardStore where key is telegram_id, value is a list as [sidequest title, sidequest description, sidequest reward, list of accepters by Telegram ID, deadline as a Unix timestamp or None].
 users - A list of (telegram_id, name) tuples.
 patches - A list of strings representing the patch history.
-archives - Key is questgiver_id, value is a list as [title, description, reward, [accepters]].
+subscribers - A set of telegram_ids who are sent every new sidequest.
+following - Key is telegram_id, value is the set of questgiver telegram_ids they follow.
+followers - The reverse of following: key is questgiver telegram_id, value is the set of their followers.
+notifications - Key is telegram_id, value is a dict of {"muted": bool, "quiet_hours": (start hour, end hour) or None}.
+namespaces - Key is a chat_id (or GLOBAL_NAMESPACE), value is the set of telegram_ids on that chat's board.
+memberships - The reverse of namespaces: key is telegram_id, value is the set of chat_ids they belong to.
+last_seen - Key is telegram_id, value is the Unix timestamp of the last update they sent.
+
+Archived sidequests aren't kept in here; they're appended to a per-user log in ARCHIVE_DIRECTORY (see append_archive).
+
+The database is saved as a snapshot:
+
+4-byte magic, 2-byte schema version, 1-byte codec, 2-byte section count (all big-endian), then a table of
+(1-byte name length, name, 8-byte offset, 8-byte length) for each section, then the sections themselves.
+Each section is one database key as compressed JSON, so any one of them can be read without the rest.
+The sidequests section holds every board, including the cold ones in the shelf, so a snapshot (and the backup
+made from it) is a complete copy of the database on its own.
+Databases saved before snapshots existed are plain pickles and count as schema version 0.
 """
-sidequest_database = pickle.load(open("./sidequestdatabase", "rb")) if os.path.isfile("./sidequestdatabase") else {}
+SNAPSHOT_MAGIC = b"SQDB"
+SNAPSHOT_HEADER = ">4sHBH"
+SNAPSHOT_CODEC_ZLIB, SNAPSHOT_CODEC_ZSTD = range(2)
+SNAPSHOT_CODEC = SNAPSHOT_CODEC_ZSTD if zstandard is not None else SNAPSHOT_CODEC_ZLIB
+
+
+def section_compressor(codec):
+    # Sections are compressed as they're written, so a large one never has to be in memory all at once.
+    if codec == SNAPSHOT_CODEC_ZSTD:
+        return zstandard.ZstdCompressor().compressobj()
+    return zlib.compressobj()
+
+
+def decompress_section(codec, data):
+    if codec == SNAPSHOT_CODEC_ZSTD:
+        if zstandard is None:
+            raise ValueError("This snapshot is zstd-compressed, but zstandard isn't installed.")
+        # Streamed frames don't record their size up front, which ZstdDecompressor.decompress() needs.
+        return zstandard.ZstdDecompressor().decompressobj().decompress(data)
+    return zlib.decompress(data)
+
+
+def dump_json(value):
+    return json.dumps(value, ensure_ascii=False, separators=(",", ":"))
+
+
+def encode_id_sets(mapping):
+    # JSON has no sets or int keys, so a dict of sets is stored as [[key, [values]], ...].
+    return [[key, sorted(values)] for key, values in mapping.items()]
+
+
+def decode_id_sets(pairs):
+    return {key: set(values) for key, values in pairs}
+
+
+def encode_boards(store):
+    # Yields the section as JSON text so the cold boards can be read from the shelf and written one at a time.
+    # The lock is held until the last one, so every board is from the same moment.
+    with store.lock:
+        yield '{"path":%s,"boards":%s,"cold":[' % (dump_json(store.path),
+                                                  dump_json([[telegram_id, board] for telegram_id, board in store.resident.items()]))
+        separator = ""
+        for key in store.shelf.keys():
+            if int(key) in store.resident:
+                continue
+            yield separator + dump_json([int(key), store.shelf[key]])
+            separator = ","
+        yield "]}"
+
+
+def decode_boards(section):
+    store = BoardStore(section["path"], {telegram_id: board for telegram_id, board in section["boards"]})
+
+    # The shelf may have changed since the snapshot was saved, so put it back the way it was then. Snapshots from
+    # before cold boards were saved with them have no "cold", and can only use the shelf as it is.
+    if "cold" in section:
+        with store.lock:
+            store.shelf.clear()
+            for telegram_id, board in section["cold"]:
+                store.shelf[str(telegram_id)] = board
+            store.shelf.sync()
+
+    return store
+
+
+def encode_pairs(mapping):
+    return [[key, value] for key, value in mapping.items()]
+
+
+def decode_notifications(pairs):
+    notifications = {}
+    for telegram_id, settings in pairs:
+        quiet_hours = settings["quiet_hours"]
+        notifications[telegram_id] = {"muted": settings["muted"],
+                                      "quiet_hours": tuple(quiet_hours) if quiet_hours is not None else None}
+    return notifications
+
+
+# Database key -> (encode, decode) between the value in memory and what json can store.
+SNAPSHOT_SECTIONS = {
+    "sidequests": (encode_boards, decode_boards),
+    "users": (lambda users: [list(user) for user in users], lambda users: [tuple(user) for user in users]),
+    "patches": (list, list),
+    "subscribers": (sorted, set),
+    "following": (encode_id_sets, decode_id_sets),
+    "followers": (encode_id_sets, decode_id_sets),
+    "notifications": (encode_pairs, decode_notifications),
+    "namespaces": (encode_id_sets, decode_id_sets),
+    "memberships": (encode_id_sets, decode_id_sets),
+    "last_seen": (encode_pairs, dict),
+}
+
+
+class SnapshotReader(object):
+    # Reads only the header and section table up front. Sections are decompressed one at a time by read().
+
+    def __init__(self, path):
+        self.path = path
+        self.sections = OrderedDict()
+
+        with open(path, "rb") as f:
+            magic, self.version, self.codec, count = struct.unpack(SNAPSHOT_HEADER, f.read(struct.calcsize(SNAPSHOT_HEADER)))
+            if magic != SNAPSHOT_MAGIC:
+                raise ValueError("%s is not a database snapshot." % path)
+            for _ in range(count):
+                name = f.read(struct.unpack(">B", f.read(1))[0]).decode("utf-8")
+                self.sections[name] = struct.unpack(">QQ", f.read(16))
+
+    def read_json(self, name):
+        offset, length = self.sections[name]
+        with open(self.path, "rb") as f:
+            f.seek(offset)
+            return json.loads(decompress_section(self.codec, f.read(length)).decode("utf-8"))
+
+    def read(self, name):
+        return SNAPSHOT_SECTIONS[name][1](self.read_json(name))
+
+
+def is_snapshot(path):
+    with open(path, "rb") as f:
+        return f.read(len(SNAPSHOT_MAGIC)) == SNAPSHOT_MAGIC
+
+
+def load_database(path, sections=None):
+    # Returns (database, schema version). Given sections, only those keys are read.
+    if not is_snapshot(path):
+        with open(path, "rb") as f:
+            return pickle.load(f), 0
+
+    reader = SnapshotReader(path)
+    if reader.version > SCHEMA_VERSION:
+        raise ValueError("%s is schema version %s, but this bot only knows up to %s." % (path, reader.version, SCHEMA_VERSION))
+
+    names = reader.sections if sections is None else sections
+    return {name: reader.read(name) for name in names}, reader.version
+
+
+def write_snapshot(path, database):
+    names = [name.encode("utf-8") for name in database]
+    table_size = sum(1 + len(name) + 16 for name in names)
+
+    # Written next to the old snapshot and swapped in, so a crash mid-save never leaves half a file behind.
+    temp_path = path + ".tmp"
+    with open(temp_path, "wb") as f:
+        f.write(struct.pack(SNAPSHOT_HEADER, SNAPSHOT_MAGIC, SCHEMA_VERSION, SNAPSHOT_CODEC, len(names)))
+        # The table is filled in once every section is written and their lengths are known.
+        f.write(b"\0" * table_size)
+
+        table = []
+        for name, value in database.items():
+            offset = f.tell()
+            encoded = SNAPSHOT_SECTIONS[name][0](value)
+            # Most encoders return a value to be dumped whole; encode_boards yields the JSON text in pieces.
+            chunks = encoded if isinstance(encoded, types.GeneratorType) else [dump_json(encoded)]
+            compressor = section_compressor(SNAPSHOT_CODEC)
+            for chunk in chunks:
+                f.write(compressor.compress(chunk.encode("utf-8")))
+            f.write(compressor.flush())
+            table.append((offset, f.tell() - offset))
+
+        f.seek(struct.calcsize(SNAPSHOT_HEADER))
+        for name, (offset, length) in zip(names, table):
+            f.write(struct.pack(">B", len(name)) + name + struct.pack(">QQ", offset, length))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temp_path, path)
+
+
+# Loaded in __main__ when the bot runs, so the command line tools never decode the bot's database or open its shelf.
+sidequest_database = {}
+DATABASE_VERSION = 0
 
 bot = telegram.Bot(token=TOKEN)
 
 
+class Leaderboard:
+    # Counts per telegram_id. The nonzero counts are also kept sorted as (-count, telegram_id), so the top k
+    # are just the first k entries and a rank is one bisect.
+
+    def __init__(self, lock=None):
+        self.lock = lock if lock is not None else RLock()
+        self.counts = {}
+        self.ranking = []
+
+    def add(self, telegram_id, delta):
+        with self.lock:
+            old = self.counts.get(telegram_id, 0)
+            new = max(old + delta, 0)
+
+            if old > 0:
+                del self.ranking[bisect.bisect_left(self.ranking, (-old, telegram_id))]
+            if new > 0:
+                bisect.insort(self.ranking, (-new, telegram_id))
+                self.counts[telegram_id] = new
+            else:
+                self.counts.pop(telegram_id, None)
+
+    def get(self, telegram_id):
+        return self.counts.get(telegram_id, 0)
+
+    def rank(self, telegram_id):
+        with self.lock:
+            count = self.counts.get(telegram_id, 0)
+            if count == 0:
+                return None
+            return bisect.bisect_left(self.ranking, (-count, telegram_id)) + 1
+
+    def top(self, k):
+        with self.lock:
+            return [(telegram_id, -count) for count, telegram_id in self.ranking[:k]]
+
+    def reset(self, counts):
+        with self.lock:
+            self.counts = {telegram_id: count for telegram_id, count in counts.items() if count > 0}
+            self.ranking = sorted((-count, telegram_id) for telegram_id, count in self.counts.items())
+
+
+# Number of sidequests each person has currently accepted.
+ACCEPTED_LEADERBOARD = Leaderboard()
+# Number of accepters across each questgiver's current sidequests.
+POPULARITY_LEADERBOARD = Leaderboard()
+
+# namespace -> (accepted, popularity) Leaderboards holding the same counts as above for just that namespace's
+# members, so /leaderboard and /stats never look at anyone outside the chat. They share one lock so a DM can read
+# several at once (see scope_top).
+NAMESPACE_LEADERBOARDS = {}
+NAMESPACE_LEADERBOARD_LOCK = RLock()
+
+
+def get_namespace_leaderboards(namespace):
+    with NAMESPACE_LEADERBOARD_LOCK:
+        if namespace not in NAMESPACE_LEADERBOARDS:
+            NAMESPACE_LEADERBOARDS[namespace] = (Leaderboard(NAMESPACE_LEADERBOARD_LOCK), Leaderboard(NAMESPACE_LEADERBOARD_LOCK))
+        return NAMESPACE_LEADERBOARDS[namespace]
+
+
+def get_scope_leaderboards(scope):
+    # ([accepted Leaderboards], [popularity Leaderboards]) for the namespaces in scope.
+    boards = [NAMESPACE_LEADERBOARDS[namespace] for namespace in sorted(scope) if namespace in NAMESPACE_LEADERBOARDS]
+    return [accepted for accepted, popularity in boards], [popularity for accepted, popularity in boards]
+
+
+def scope_top(leaderboards, k):
+    # The top k across several namespaces' Leaderboards. Someone in more than one has the same count in each, so
+    # they're merged in order and only counted the first time they come up.
+    with NAMESPACE_LEADERBOARD_LOCK:
+        top = []
+        seen = set()
+        for count, telegram_id in heapq.merge(*[leaderboard.ranking for leaderboard in leaderboards]):
+            if len(top) == k:
+                break
+            if telegram_id not in seen:
+                seen.add(telegram_id)
+                top.append((telegram_id, -count))
+        return top
+
+
+def scope_rank(leaderboards, telegram_id, count):
+    # Where someone with this count places across several namespaces' Leaderboards, whether or not they're in them.
+    if count == 0:
+        return None
+    with NAMESPACE_LEADERBOARD_LOCK:
+        if len(leaderboards) == 1:
+            return bisect.bisect_left(leaderboards[0].ranking, (-count, telegram_id)) + 1
+        ahead = set()
+        for leaderboard in leaderboards:
+            position = bisect.bisect_left(leaderboard.ranking, (-count, telegram_id))
+            ahead.update(ahead_id for ahead_count, ahead_id in leaderboard.ranking[:position])
+        return len(ahead) + 1
+
+
 def send_message(chat_id, text, photo=None):
     try:
         if len(text) > 4096:
@@ -82,12 +587,54 @@ def restricted(func):
     def wrapped(update, context, *args, **kwargs):
         user_id = update.effective_user.id
         if user_id not in ADMIN:
-            print("Unauthorized access denied for {}.".format(user_id))
+            ERROR_LOGGER.warning("Unauthorized access denied.", extra={"fields": {"user_id": user_id, "command": func.__name__}})
             return
         return func(update, context, *args, **kwargs)
     return wrapped
 
 
+def get_notification_settings(telegram_id):
+    return sidequest_database["notifications"].get(telegram_id, {"muted": False, "quiet_hours": None})
+
+
+def in_quiet_hours(quiet_hours, hour):
+    if quiet_hours is None:
+        return False
+    start, end = quiet_hours
+    # Quiet hours can wrap around midnight, e.g. (22, 7).
+    if start <= end:
+        return start <= hour < end
+    return hour >= start or hour < end
+
+
+def filter_recipients(telegram_ids):
+    # Drops anyone who has muted notifications. Returns (telegram_id, silent) pairs, where silent means the
+    # message should be delivered without a notification because it's their quiet hours.
+    # Quiet hours are set in UTC, since the server's local time means nothing to the people using the bot.
+    hour = datetime.datetime.utcnow().hour
+    recipients = []
+
+    for telegram_id in telegram_ids:
+        settings = get_notification_settings(telegram_id)
+        if settings["muted"]:
+            continue
+        recipients.append((telegram_id, in_quiet_hours(settings["quiet_hours"], hour)))
+
+    return recipients
+
+
+# Held by every handler and job that changes the database, since jobs run on their own threads.
+DATABASE_LOCK = RLock()
+
+
+def synchronized(func):
+    @wraps(func)
+    def wrapped(*args, **kwargs):
+        with DATABASE_LOCK:
+            return func(*args, **kwargs)
+    return wrapped
+
+
 def send_patchnotes():
     path = "./static_responses/patchnotes/patchnotes_" + PATCHNUMBER + ".txt"
 
@@ -96,12 +643,189 @@ def send_patchnotes():
 
     text = open(path, "r").read()
 
-    for (telegram_id, name) in sidequest_database["users"]:
-        send_message(telegram_id, text)
+    for telegram_id, silent in filter_recipients([id for id, name in sidequest_database["users"]]):
+        try:
+            bot.send_message(chat_id=telegram_id, text=text, parse_mode=telegram.ParseMode.HTML,
+                             disable_notification=silent)
+        except Unauthorized:
+            continue
 
     sidequest_database["patches"].append(PATCHNUMBER)
 
 
+def get_archive_path(telegram_id):
+    return os.path.join(ARCHIVE_DIRECTORY, "%d.log" % telegram_id)
+
+
+def append_archive(telegram_id, quest):
+    # Each record in the log is a 4-byte big-endian length followed by a zlib-compressed
+    # JSON list of [title, description, reward, [accepters]]. Records are only ever appended.
+    payload = zlib.compress(json.dumps(quest[:4]).encode("utf-8"))
+
+    os.makedirs(ARCHIVE_DIRECTORY, exist_ok=True)
+    with open(get_archive_path(telegram_id), "ab") as f:
+        f.write(struct.pack(">I", len(payload)) + payload)
+
+
+def read_archive_index(telegram_id):
+    # Returns the (offset, length) of every record without decompressing any of them.
+    index = []
+    path = get_archive_path(telegram_id)
+
+    if not os.path.isfile(path):
+        return index
+
+    size = os.path.getsize(path)
+    with open(path, "rb") as f:
+        while True:
+            header = f.read(4)
+            if len(header) < 4:
+                break
+            length = struct.unpack(">I", header)[0]
+            offset = f.tell()
+            # Ignore a partially written record at the end of the log.
+            if offset + length > size:
+                break
+            index.append((offset, length))
+            f.seek(length, os.SEEK_CUR)
+
+    return index
+
+
+def iter_archive(telegram_id):
+    path = get_archive_path(telegram_id)
+
+    if not os.path.isfile(path):
+        return
+
+    with open(path, "rb") as f:
+        while True:
+            header = f.read(4)
+            if len(header) < 4:
+                return
+            length = struct.unpack(">I", header)[0]
+            payload = f.read(length)
+            if len(payload) < length:
+                return
+            yield json.loads(zlib.decompress(payload).decode("utf-8"))
+
+
+def get_archived_ids():
+    if not os.path.isdir(ARCHIVE_DIRECTORY):
+        return []
+    return [int(filename[:-len(".log")]) for filename in os.listdir(ARCHIVE_DIRECTORY) if filename.endswith(".log")]
+
+
+def read_archive_page(telegram_id, page):
+    # Pages are newest first. Returns the quests on that page and the total number of pages.
+    index = read_archive_index(telegram_id)
+    page_count = max(1, (len(index) + ARCHIVES_PAGE_SIZE - 1) // ARCHIVES_PAGE_SIZE)
+    page = min(max(page, 0), page_count - 1)
+
+    end = len(index) - page * ARCHIVES_PAGE_SIZE
+    start = max(0, end - ARCHIVES_PAGE_SIZE)
+
+    quests = []
+    if end > start:
+        with open(get_archive_path(telegram_id), "rb") as f:
+            for offset, length in reversed(index[start:end]):
+                f.seek(offset)
+                quests.append(json.loads(zlib.decompress(f.read(length)).decode("utf-8")))
+
+    return quests, page, page_count
+
+
+def shorten(text, length):
+    text = str(text) if text is not None else ""
+    return text if len(text) <= length else text[:length] + "..."
+
+
+def make_archives_page(telegram_id, page):
+    quests, page, page_count = read_archive_page(telegram_id, page)
+
+    if len(quests) == 0:
+        return "<b>Your Archived Sidequests:</b>\n\nYou haven't archived any sidequests yet!", []
+
+    text = "<b>Your Archived Sidequests (page %s of %s):</b>" % (page + 1, page_count)
+    for title, description, reward, accepters in quests:
+        accepter_names = ", ".join(get_name_from_database(id) for id in accepters)
+        # Only the user's text is shortened, never the finished HTML, so a tag can't be cut in half.
+        text += "\n\n<b>Title:</b> %s" % shorten(title, ARCHIVE_FIELD_PREVIEW_LENGTH) + \
+                "\n<b>Description:</b> %s" % shorten(description, ARCHIVE_PREVIEW_LENGTH) + \
+                "\n<b>Reward:</b> %s" % shorten(reward, ARCHIVE_FIELD_PREVIEW_LENGTH) + \
+                "\n<b>Accepters:</b> %s" % shorten(accepter_names, ARCHIVE_FIELD_PREVIEW_LENGTH)
+
+    buttons = []
+    if page > 0:
+        # Callback data for archives is:
+        # [ARCHIVES (header), Owner's Telegram ID, Page]
+        buttons.append(telegram.InlineKeyboardButton(text="⬅️", callback_data="ARCHIVES,%s,%s" % (telegram_id, page - 1)))
+    if page < page_count - 1:
+        buttons.append(telegram.InlineKeyboardButton(text="➡️", callback_data="ARCHIVES,%s,%s" % (telegram_id, page + 1)))
+
+    return text, [buttons] if len(buttons) > 0 else []
+
+
+def count_accept(questgiver_id, accepter_id, delta):
+    ACCEPTED_LEADERBOARD.add(accepter_id, delta)
+    POPULARITY_LEADERBOARD.add(questgiver_id, delta)
+
+    for namespace in sidequest_database["memberships"].get(accepter_id, ()):
+        get_namespace_leaderboards(namespace)[0].add(accepter_id, delta)
+    for namespace in sidequest_database["memberships"].get(questgiver_id, ()):
+        get_namespace_leaderboards(namespace)[1].add(questgiver_id, delta)
+
+
+def count_removed_sidequest(questgiver_id, quest):
+    for accepter in quest[3]:
+        count_accept(questgiver_id, accepter, -1)
+
+
+def count_leaderboards():
+    accepted = defaultdict(int)
+    popularity = defaultdict(int)
+
+    store = sidequest_database["sidequests"]
+    for questgiver_id in store.keys():
+        for quest in store.peek(questgiver_id):
+            popularity[questgiver_id] += len(quest[3])
+            for accepter in quest[3]:
+                accepted[accepter] += 1
+
+    return accepted, popularity
+
+
+def reconcile_leaderboards():
+    # Recounts everything from the boards and replaces the counters. Returns how many entries had drifted.
+    accepted, popularity = count_leaderboards()
+
+    pairs = [(ACCEPTED_LEADERBOARD, accepted), (POPULARITY_LEADERBOARD, popularity)]
+    with NAMESPACE_LEADERBOARD_LOCK:
+        for namespace in set(NAMESPACE_LEADERBOARDS) - set(sidequest_database["namespaces"]):
+            del NAMESPACE_LEADERBOARDS[namespace]
+        for namespace, members in sidequest_database["namespaces"].items():
+            namespace_accepted, namespace_popularity = get_namespace_leaderboards(namespace)
+            pairs.append((namespace_accepted, {id: accepted[id] for id in members if id in accepted}))
+            pairs.append((namespace_popularity, {id: popularity[id] for id in members if id in popularity}))
+
+        drift = 0
+        for leaderboard, counts in pairs:
+            with leaderboard.lock:
+                for telegram_id in set(leaderboard.counts) | set(counts):
+                    if leaderboard.get(telegram_id) != counts.get(telegram_id, 0):
+                        drift += 1
+                leaderboard.reset(counts)
+
+    return drift
+
+
+@synchronized
+def reconcile_leaderboards_job(context):
+    drift = reconcile_leaderboards()
+    if drift > 0:
+        ERROR_LOGGER.warning("Leaderboard counters drifted from the boards.", extra={"fields": {"entries": drift}})
+
+
 def get_username(user):
     username = ""
     if user.username is not None:
@@ -120,28 +844,193 @@ def get_username(user):
     return username
 
 
+# telegram_id -> name for everyone in sidequest_database["users"], so lookups don't scan the list.
+USER_NAMES = {}
+
+
+def index_users():
+    USER_NAMES.clear()
+    USER_NAMES.update(sidequest_database["users"])
+
+
 def check_profile_existence(id):
-    for cur_id, name in sidequest_database["users"]:
-        if cur_id == id:
-            return True
-    return False
+    return id in USER_NAMES
+
+
+def join_namespace(telegram_id, namespace):
+    if telegram_id in sidequest_database["namespaces"].get(namespace, ()):
+        return
+    sidequest_database["namespaces"].setdefault(namespace, set()).add(telegram_id)
+    sidequest_database["memberships"].setdefault(telegram_id, set()).add(namespace)
+
+    accepted, popularity = get_namespace_leaderboards(namespace)
+    accepted.add(telegram_id, ACCEPTED_LEADERBOARD.get(telegram_id))
+    popularity.add(telegram_id, POPULARITY_LEADERBOARD.get(telegram_id))
+
+
+def leave_namespace(telegram_id, namespace):
+    sidequest_database["namespaces"].get(namespace, set()).discard(telegram_id)
+    sidequest_database["memberships"].get(telegram_id, set()).discard(namespace)
+
+    with NAMESPACE_LEADERBOARD_LOCK:
+        for leaderboard in NAMESPACE_LEADERBOARDS.get(namespace, ()):
+            leaderboard.add(telegram_id, -leaderboard.get(telegram_id))
+
+    if len(sidequest_database["namespaces"].get(namespace, ())) == 0:
+        sidequest_database["namespaces"].pop(namespace, None)
+        with NAMESPACE_LEADERBOARD_LOCK:
+            NAMESPACE_LEADERBOARDS.pop(namespace, None)
+    if len(sidequest_database["memberships"].get(telegram_id, ())) == 0:
+        sidequest_database["memberships"].pop(telegram_id, None)
+
+
+def get_scope(chat, telegram_id):
+    # A group only sees its own board. In a DM you see every group you're in, or the global board if none.
+    if chat.type != telegram.Chat.PRIVATE:
+        return set([chat.id])
+    memberships = sidequest_database["memberships"].get(telegram_id)
+    return set(memberships) if memberships else set([GLOBAL_NAMESPACE])
+
+
+def get_scope_members(scope):
+    members = set()
+    for namespace in scope:
+        members.update(sidequest_database["namespaces"].get(namespace, ()))
+    return members
+
+
+def get_scope_users(scope):
+    # (telegram_id, name) for everyone in scope, sorted by name like sidequest_database["users"].
+    return sorted(((id, USER_NAMES[id]) for id in get_scope_members(scope) if id in USER_NAMES),
+                  key=lambda x: str(x[1]).lower())
+
+
+def find_user_id(name, scope):
+    for id, username in get_scope_users(scope):
+        if name.lower() in username.lower():
+            return id
+    return None
+
+
+def follow(telegram_id, questgiver_id):
+    sidequest_database["following"].setdefault(telegram_id, set()).add(questgiver_id)
+    sidequest_database["followers"].setdefault(questgiver_id, set()).add(telegram_id)
+
+
+def unfollow(telegram_id, questgiver_id):
+    sidequest_database["following"].get(telegram_id, set()).discard(questgiver_id)
+    sidequest_database["followers"].get(questgiver_id, set()).discard(telegram_id)
+
+
+def remove_from_follow_graph(telegram_id):
+    for questgiver_id in sidequest_database["following"].pop(telegram_id, set()):
+        sidequest_database["followers"].get(questgiver_id, set()).discard(telegram_id)
+    for follower_id in sidequest_database["followers"].pop(telegram_id, set()):
+        sidequest_database["following"].get(follower_id, set()).discard(telegram_id)
+    sidequest_database["notifications"].pop(telegram_id, None)
+
+
+def remove_users(telegram_ids):
+    # Removes everyone in telegram_ids completely: their profiles, boards, follows and every sidequest they accepted,
+    # in a single pass over the boards. Returns (sidequests deleted, accepts removed).
+    sidequest_database["users"] = [(id, name) for id, name in sidequest_database["users"] if id not in telegram_ids]
+
+    store = sidequest_database["sidequests"]
+    deleted = 0
+
+    for telegram_id in telegram_ids:
+        USER_NAMES.pop(telegram_id, None)
+
+        for namespace in list(sidequest_database["memberships"].pop(telegram_id, ())):
+            leave_namespace(telegram_id, namespace)
+
+        sidequest_database["subscribers"].discard(telegram_id)
+        sidequest_database["last_seen"].pop(telegram_id, None)
+        remove_from_follow_graph(telegram_id)
+
+        if telegram_id in store:
+            for quest in store[telegram_id]:
+                count_removed_sidequest(telegram_id, quest)
+            deleted += len(store[telegram_id])
+            del store[telegram_id]
+
+    # Only the boards they've actually accepted something on are loaded.
+    accepts = 0
+    for id in store.keys():
+        if not any(accepter in telegram_ids for quest in store.peek(id) for accepter in quest[3]):
+            continue
+        for quest in store[id]:
+            removed = [accepter for accepter in quest[3] if accepter in telegram_ids]
+            for accepter in removed:
+                quest[3].remove(accepter)
+                count_accept(id, accepter, -1)
+            accepts += len(removed)
+
+    return deleted, accepts
+
+
+def remove_user(telegram_id):
+    remove_users(set([telegram_id]))
+
+
+def get_inactive_users(days):
+    cutoff = time.time() - days * 24 * 3600
+    return set(id for id, name in sidequest_database["users"]
+               if id not in ADMIN and sidequest_database["last_seen"].get(id, 0) < cutoff)
+
+
+def remove_sidequests(matches, dispatcher, archive=False):
+    # Deletes (or archives) every sidequest where matches(questgiver_id, quest) is true, in a single pass over the
+    # boards. Boards without a match are only peeked at, and boards being edited are skipped like in purge_drafts_job.
+    # Returns (list of (questgiver_id, quest) removed, boards changed).
+    store = sidequest_database["sidequests"]
+    removed = []
+    boards = 0
+
+    for questgiver_id in store.keys():
+        if not any(matches(questgiver_id, quest) for quest in store.peek(questgiver_id)):
+            continue
+        if is_editing(dispatcher, questgiver_id):
+            continue
+
+        board = store[questgiver_id]
+        remaining = []
+        for quest in board:
+            if matches(questgiver_id, quest):
+                removed.append((questgiver_id, quest))
+            else:
+                remaining.append(quest)
+        board[:] = remaining
+        boards += 1
+
+    for questgiver_id, quest in removed:
+        if archive:
+            append_archive(questgiver_id, quest)
+        count_removed_sidequest(questgiver_id, quest)
+
+    return removed, boards
+
+
+@synchronized
+def touch_last_seen(update, context):
+    user = update.effective_user
+    if user is not None and check_profile_existence(user.id):
+        sidequest_database["last_seen"][user.id] = time.time()
 
 
 def get_name_from_database(id):
-    for cur_id, name in sidequest_database["users"]:
-        if cur_id == id:
-            return name
-    return ""
+    return USER_NAMES.get(id, "")
 
 
 def users_handler(update, context):
     chat_id = update.message.chat.id
+    user = update.message.from_user
     # Callback data for display is:
     # [SHOWALL (header)]
     buttons = [[telegram.InlineKeyboardButton(text="Show All", callback_data="SHOWALL")]]
 
     text = "Users:"
-    for id, name in sidequest_database["users"]:
+    for id, name in get_scope_users(get_scope(update.message.chat, user.id)):
         # Callback data for display is:
         # [DISPLAY (header), telegram_id]
         buttons.append([telegram.InlineKeyboardButton(text=name, callback_data="DISPLAY,%d" % id)])
@@ -152,17 +1041,23 @@ def users_handler(update, context):
                      parse_mode=telegram.ParseMode.HTML)
 
 
+def format_deadline(deadline):
+    # In UTC, like quiet hours, since the bot doesn't know anyone's time zone.
+    return datetime.datetime.utcfromtimestamp(deadline).strftime("%m/%d/%Y %H:%M UTC")
+
+
 def make_display_buttons(telegram_id, requester_id):
     buttons = []
     count = 0
 
     if telegram_id == requester_id:
-        for title, description, reward, accepters in sidequest_database["sidequests"][telegram_id]:
+        for title, description, reward, accepters, deadline in sidequest_database["sidequests"][telegram_id]:
             buttons.append(
                 [
                     # Callback data for show is:
                     # [SHOW (header), Sidequest Giver Telegram ID, Sidequest ID]
-                    telegram.InlineKeyboardButton(text=title if title != "" else "[NO TITLE]",
+                    # Your own sidequests are numbered, since /deadline takes that number.
+                    telegram.InlineKeyboardButton(text="%s. %s" % (count + 1, title if title != "" else "[NO TITLE]"),
                                                   callback_data="SHOW,%s,%s" % (telegram_id, count))
                 ]
             )
@@ -184,7 +1079,7 @@ def make_display_buttons(telegram_id, requester_id):
             )
             count += 1
     else:
-        for title, description, reward, accepters in sidequest_database["sidequests"][telegram_id]:
+        for title, description, reward, accepters, deadline in sidequest_database["sidequests"][telegram_id]:
             buttons.append(
                 [
                     # Callback data for show is:
@@ -212,10 +1107,10 @@ def make_display_buttons(telegram_id, requester_id):
 def make_my_sidequest_buttons(telegram_id):
     buttons = []
 
-    for id, name in sidequest_database["users"]:
+    for id, name in get_scope_users(sidequest_database["memberships"].get(telegram_id, ())):
         if id != telegram_id:
             count = 0
-            for title, description, reward, accepters in sidequest_database["sidequests"][id]:
+            for title, description, reward, accepters, deadline in sidequest_database["sidequests"].peek(id):
                 if telegram_id in accepters:
                     buttons.append(
                         [
@@ -261,11 +1156,7 @@ def display_handler(update, context):
     user = update.message.from_user
 
     if len(context.args) < 1:
-        username = ""
-        for (id, name) in sidequest_database["users"]:
-            if id == user.id:
-                username = name
-                break
+        username = get_name_from_database(user.id)
 
         if username == "":
             send_message(chat_id, "You haven't joined using /am!")
@@ -281,12 +1172,14 @@ def display_handler(update, context):
         send_message(chat_id, "Usage: /display [name]")
         return
 
+    users = get_scope_users(get_scope(update.message.chat, user.id))
+
     try:
         user_id = int(context.args[0])
     except ValueError:
         user_id = -1
         name = " ".join(context.args)
-        for i, tup in enumerate(sidequest_database["users"]):
+        for i, tup in enumerate(users):
             if name.lower() in tup[1].lower():
                 user_id = i
                 break
@@ -294,17 +1187,18 @@ def display_handler(update, context):
             send_message(chat_id, "Error: Could not find a matching name!")
             return
 
-    if user_id < 0 or user_id >= len(sidequest_database["users"]):
+    if user_id < 0 or user_id >= len(users):
         send_message(chat_id, "That (%s) is not a valid ID in the range [%s, %s)!" %
-                     (user_id, 0, len(sidequest_database["users"])))
+                     (user_id, 0, len(users)))
         return
 
     bot.send_message(chat_id=chat_id,
-                     text="<b>Sidequests for %s:</b>\n\n" % sidequest_database["users"][user_id][1],
-                     reply_markup=telegram.InlineKeyboardMarkup(make_display_buttons(sidequest_database["users"][user_id][0], user.id)),
+                     text="<b>Sidequests for %s:</b>\n\n" % users[user_id][1],
+                     reply_markup=telegram.InlineKeyboardMarkup(make_display_buttons(users[user_id][0], user.id)),
                      parse_mode=telegram.ParseMode.HTML)
 
 
+@synchronized
 def add_me_handler(update, context):
     chat_id = update.message.chat.id
     user = update.message.from_user
@@ -314,35 +1208,34 @@ def add_me_handler(update, context):
     else:
         username = " ".join(context.args)
 
-    for id, name in sidequest_database["users"]:
-        if id == user.id:
+    namespace = chat_id if update.message.chat.type != telegram.Chat.PRIVATE else GLOBAL_NAMESPACE
+
+    if check_profile_existence(user.id):
+        if user.id in sidequest_database["namespaces"].get(namespace, ()):
             send_message(chat_id, "You're already in the database!")
-            return
+        else:
+            join_namespace(user.id, namespace)
+            send_message(chat_id, "You've joined this board!")
+        return
 
     sidequest_database["users"].append((user.id, username))
+    USER_NAMES[user.id] = username
+    sidequest_database["last_seen"][user.id] = time.time()
+    join_namespace(user.id, namespace)
     # Sort by name
     sidequest_database["users"] = sorted(sidequest_database["users"], key=lambda x: str(x[1]).lower())
 
-    send_message(chat_id, "You've been added! Make sure to send me a DM to be able to get messages!")
+    # Announcements are opt-in for new users; only people from before subscriptions existed start subscribed.
+    send_message(chat_id, "You've been added! Make sure to send me a DM to be able to get messages! "
+                          "Use /subscribe to be told about every new sidequest, or /follow someone to hear about theirs.")
 
 
+@synchronized
 def remove_me_confirmed_handler(update, context):
     chat_id = update.message.chat.id
     user = update.message.from_user
 
-    for id, name in sidequest_database["users"]:
-        if id == user.id:
-            sidequest_database["users"].remove((id, name))
-            break
-
-    for id in sidequest_database["sidequests"].keys():
-        if id == user.id:
-            del sidequest_database["sidequests"][user.id]
-            break
-        else:
-            for title, description, reward, accepters in sidequest_database["sidequests"][id]:
-                if user.id in accepters:
-                    accepters.remove(user.id)
+    remove_user(user.id)
 
     send_message(chat_id, "You've been removed!")
 
@@ -351,13 +1244,14 @@ def remove_me_handler(update, context):
     chat_id = update.message.chat.id
     user = update.message.from_user
 
-    if user.id not in [t[0] for t in sidequest_database["users"]]:
+    if not check_profile_existence(user.id):
         send_message(chat_id, "You haven't made an account by joining using /am!")
         return
 
     send_message(chat_id, "Are you sure you want to leave? If so, use /rmc.")
 
 
+@synchronized
 def ban_handler(update, context):
     chat_id = update.message.chat.id
 
@@ -365,12 +1259,15 @@ def ban_handler(update, context):
         send_message(chat_id, "Usage: /ban {ID from /users or name}")
         return
 
+    # IDs are positions in the list /users shows in this chat, so resolve them against the same scope.
+    users = get_scope_users(get_scope(update.message.chat, update.message.from_user.id))
+
     try:
         user_id = int(context.args[0])
     except ValueError:
         user_id = -1
         name = str(context.args[0])
-        for i, tup in enumerate(sidequest_database["users"]):
+        for i, tup in enumerate(users):
             if name.lower() in tup[1].lower():
                 user_id = i
                 break
@@ -378,22 +1275,14 @@ def ban_handler(update, context):
             send_message(chat_id, "Error: Could not find a matching name!")
             return
 
-    if user_id < 0 or user_id >= len(sidequest_database["users"]):
+    if user_id < 0 or user_id >= len(users):
         send_message(chat_id, "That (%s) is not a valid ID in the range [%s, %s)!" %
-                     (user_id, 0, len(sidequest_database["users"])))
+                     (user_id, 0, len(users)))
         return
 
-    telegram_id = sidequest_database["users"][user_id][0]
-
-    for id, username in sidequest_database["users"]:
-        if id == telegram_id:
-            sidequest_database["users"].remove((telegram_id, username))
-            break
+    telegram_id = users[user_id][0]
 
-    for id in sidequest_database["sidequests"].keys():
-        if id == telegram_id:
-            del sidequest_database["sidequests"][telegram_id]
-            break
+    remove_user(telegram_id)
 
     send_message(chat_id, "That user has been removed!")
 
@@ -402,14 +1291,15 @@ def show_all_handler(update, context):
     chat_id = update.message.chat.id
     user = update.message.from_user
 
-    for id, name in sidequest_database["users"]:
-        if id != user.id and len(sidequest_database["sidequests"][id]) > 0:
+    for id, name in get_scope_users(get_scope(update.message.chat, user.id)):
+        if id != user.id and len(sidequest_database["sidequests"].peek(id)) > 0:
             bot.send_message(chat_id=chat_id,
                              text="<b>Sidequests for %s:</b>\n\n" % name,
                              reply_markup=telegram.InlineKeyboardMarkup(make_display_buttons(id, user.id)),
                              parse_mode=telegram.ParseMode.HTML)
 
 
+@synchronized
 def button_handler(update, context):
     query = update.callback_query
     user_id = int(query.from_user.id)
@@ -420,6 +1310,13 @@ def button_handler(update, context):
         send_message(user_id, "You don't have a sidequest board yet! Make one using /am.")
         return ConversationHandler.END
 
+    # Buttons stay around after their sidequest is deleted, archived or expired, so check it's still there.
+    if split_data[0] in ("TOGGLE", "DELETE", "ARCHIVE", "EDIT", "SHOW", "LIST"):
+        quest_id = int(split_data[2])
+        if quest_id < 0 or quest_id >= len(sidequest_database["sidequests"].peek(int(split_data[1]))):
+            send_message(user_id, "That sidequest isn't there anymore! Use /display to see the current ones.")
+            return ConversationHandler.END
+
     if split_data[0] == "TOGGLE":
         questgiver_id = int(split_data[1])
         quest_id = int(split_data[2])
@@ -430,10 +1327,12 @@ def button_handler(update, context):
 
         if user_id in sidequest_database["sidequests"][questgiver_id][quest_id][3]:
             sidequest_database["sidequests"][questgiver_id][quest_id][3].remove(user_id)
+            count_accept(questgiver_id, user_id, -1)
             send_message(questgiver_id, "%s is no longer doing sidequest %s." % (get_name_from_database(user_id), sidequest_database["sidequests"][questgiver_id][quest_id][0]))
             send_message(user_id, "You are no longer doing sidequest %s for %s." % (sidequest_database["sidequests"][questgiver_id][quest_id][0], get_name_from_database(questgiver_id)))
         else:
             sidequest_database["sidequests"][questgiver_id][quest_id][3].append(user_id)
+            count_accept(questgiver_id, user_id, 1)
             send_message(questgiver_id, "%s has accepted your sidequest %s." % (get_name_from_database(user_id), sidequest_database["sidequests"][questgiver_id][quest_id][0]))
             send_message(user_id, "You have accepted sidequest %s for %s." % (sidequest_database["sidequests"][questgiver_id][quest_id][0], get_name_from_database(questgiver_id)))
 
@@ -450,11 +1349,12 @@ def button_handler(update, context):
             send_message(user_id, "That's not your sidequest list!")
             return
 
-        title, description, reward, accepters = sidequest_database["sidequests"][questgiver_id][quest_id]
+        title, description, reward, accepters, deadline = sidequest_database["sidequests"][questgiver_id][quest_id]
 
         for accepter in accepters:
             send_message(accepter, "The sidequest, %s by %s, you were on was just deleted!" % (title, get_name_from_database(questgiver_id)))
 
+        count_removed_sidequest(questgiver_id, sidequest_database["sidequests"][questgiver_id][quest_id])
         del sidequest_database["sidequests"][questgiver_id][quest_id]
 
         bot.edit_message_text(chat_id=user_id,
@@ -470,12 +1370,13 @@ def button_handler(update, context):
             send_message(user_id, "That's not your sidequest list!")
             return
 
-        title, description, reward, accepters = sidequest_database["sidequests"][questgiver_id][quest_id]
+        title, description, reward, accepters, deadline = sidequest_database["sidequests"][questgiver_id][quest_id]
 
         for accepter in accepters:
             send_message(accepter, "The sidequest, %s by %s, you were on was just archived!" % (title, get_name_from_database(questgiver_id)))
 
-        sidequest_database["archives"][questgiver_id] = sidequest_database["sidequests"][questgiver_id][quest_id][:]
+        append_archive(questgiver_id, sidequest_database["sidequests"][questgiver_id][quest_id])
+        count_removed_sidequest(questgiver_id, sidequest_database["sidequests"][questgiver_id][quest_id])
         del sidequest_database["sidequests"][questgiver_id][quest_id]
 
         bot.edit_message_text(chat_id=user_id,
@@ -491,7 +1392,9 @@ def button_handler(update, context):
             send_message(user_id, "That's not your sidequest list!")
             return
 
+        context.user_data.pop("draft", None)
         context.user_data["current_quest"] = quest_id
+        context.user_data["editing_since"] = time.time()
         send_message(user_id, "Let's begin editing that sidequest! "
                               "First, send me a title, use /skiptitle, or use /removetitle. "
                               "You can cancel at any time using /cancel.")
@@ -509,21 +1412,43 @@ def button_handler(update, context):
         questgiver_id = int(split_data[1])
         quest_id = int(split_data[2])
 
-        title, description, reward, accepters = sidequest_database["sidequests"][questgiver_id][quest_id]
+        title, description, reward, accepters, deadline = sidequest_database["sidequests"][questgiver_id][quest_id]
+
+        text = "<b>Title:</b> %s" % title + "\n\n<b>Description:</b> %s" % description + "\n\n<b>Reward:</b> %s" % reward
+        if deadline is not None:
+            text += "\n\n<b>Deadline:</b> %s" % format_deadline(deadline)
 
-        send_message(user_id, "<b>Title:</b> %s" % title + "\n\n<b>Description:</b> %s" % description + "\n\n<b>Reward:</b> %s" % reward)
+        send_message(user_id, text)
     elif split_data[0] == "SHOWALL":
-        for id, name in sidequest_database["users"]:
-            if id != user_id and len(sidequest_database["sidequests"][id]) > 0:
+        # The button was pressed under a /users message, so use that chat's scope.
+        for id, name in get_scope_users(get_scope(query.message.chat, user_id)):
+            if id != user_id and len(sidequest_database["sidequests"].peek(id)) > 0:
                 bot.send_message(chat_id=user_id,
                                  text="<b>Sidequests for %s:</b>\n\n" % name,
                                  reply_markup=telegram.InlineKeyboardMarkup(make_display_buttons(id, user_id)),
                                  parse_mode=telegram.ParseMode.HTML)
+    elif split_data[0] == "ARCHIVES":
+        # Buttons from before the owner was in the callback data only have the page.
+        owner_id = int(split_data[1]) if len(split_data) > 2 else user_id
+        page = int(split_data[-1])
+
+        # In a group anyone can press the buttons, but the page stays with whoever ran /archives.
+        if owner_id != user_id:
+            send_message(user_id, "Those are someone else's archives! Use /archives to see your own.")
+            return ConversationHandler.END
+
+        text, buttons = make_archives_page(owner_id, page)
+
+        bot.edit_message_text(chat_id=query.message.chat.id,
+                              message_id=query.message.message_id,
+                              text=text,
+                              reply_markup=telegram.InlineKeyboardMarkup(buttons),
+                              parse_mode="HTML")
     elif split_data[0] == "LIST":
         questgiver_id = int(split_data[1])
         quest_id = int(split_data[2])
 
-        title, description, reward, accepters = sidequest_database["sidequests"][questgiver_id][quest_id]
+        title, description, reward, accepters, deadline = sidequest_database["sidequests"][questgiver_id][quest_id]
 
         text = "The following people have accepted this sidequest:\n\n"
         for id in accepters:
@@ -533,6 +1458,7 @@ def button_handler(update, context):
     return ConversationHandler.END
 
 
+@synchronized
 def sidequest_handler(update, context):
     chat_id = update.message.chat_id
     user = update.message.from_user
@@ -541,9 +1467,11 @@ def sidequest_handler(update, context):
         send_message(chat_id, "You don't have a sidequest board yet! Make one using /am.")
         return ConversationHandler.END
 
-    # Add a new empty sidequest.
-    sidequest_database["sidequests"][update.message.from_user.id].append(["","","",[]])
-    context.user_data["current_quest"] = len(sidequest_database["sidequests"][update.message.from_user.id]) - 1
+    # A new sidequest is kept as a draft in user_data and only goes on the board once it's finished, so an
+    # abandoned editor never leaves anything behind on the board.
+    context.user_data["draft"] = ["", "", "", [], None]
+    context.user_data.pop("current_quest", None)
+    context.user_data["editing_since"] = time.time()
 
     send_message(chat_id, "Let's begin adding a new sidequest! "
                           "First, send me a title, use /skiptitle, or use /removetitle. "
@@ -552,40 +1480,85 @@ def sidequest_handler(update, context):
     return TITLE
 
 
+def get_edited_quest(context, telegram_id):
+    # The sidequest an editor is working on: its draft, or the one on the board it's editing. Returns None if
+    # the draft was purged or the sidequest has since been removed from the board.
+    if "draft" in context.user_data:
+        return context.user_data["draft"]
+
+    quest_id = context.user_data.get("current_quest")
+    board = sidequest_database["sidequests"][telegram_id]
+    if quest_id is None or quest_id >= len(board):
+        return None
+    return board[quest_id]
+
+
+def end_lost_editor(update, context):
+    update.message.reply_text("That sidequest isn't there anymore. Start a new one with /sidequest.")
+    context.user_data.pop("draft", None)
+    context.user_data.pop("current_quest", None)
+    context.user_data.pop("editing_since", None)
+    return ConversationHandler.END
+
+
+def finish_editing(context, telegram_id):
+    # Puts a finished draft on the board and announces it. Edited sidequests are announced again, as before.
+    board = sidequest_database["sidequests"][telegram_id]
+    if "draft" in context.user_data:
+        board.append(context.user_data.pop("draft"))
+        quest_id = len(board) - 1
+    else:
+        quest_id = context.user_data["current_quest"]
+
+    announce_sidequest(telegram_id, quest_id)
+
+    context.user_data.pop("current_quest", None)
+    context.user_data.pop("editing_since", None)
+
+
+@synchronized
 def add_title_handler(update, context):
     user = update.message.from_user
     title = update.message.text
-    quest_id = context.user_data["current_quest"]
     chat_id = update.message.chat_id
 
     if not check_profile_existence(user.id):
         send_message(chat_id, "You don't have a sidequest board yet! Make one using /am.")
         return ConversationHandler.END
 
-    sidequest_database["sidequests"][user.id][quest_id][0] = title
+    quest = get_edited_quest(context, user.id)
+    if quest is None:
+        return end_lost_editor(update, context)
+
+    quest[0] = title
 
     update.message.reply_text("Now send me some text for the description, use /skipdesc, or use /removedesc.")
 
     return DESCRIPTION
 
 
+@synchronized
 def add_description_handler(update, context):
     user = update.message.from_user
     description = update.message.text
-    quest_id = context.user_data["current_quest"]
     chat_id = update.message.chat_id
 
     if not check_profile_existence(user.id):
         send_message(chat_id, "You don't have a sidequest board yet! Make one using /am.")
         return ConversationHandler.END
 
-    sidequest_database["sidequests"][user.id][quest_id][1] = description
+    quest = get_edited_quest(context, user.id)
+    if quest is None:
+        return end_lost_editor(update, context)
+
+    quest[1] = description
 
     update.message.reply_text("Thanks! Lastly, you need to send some text for the reward, use /skipreward, or use /removereward.")
 
     return REWARD
 
 
+@synchronized
 def skip_title_handler(update, context):
     chat_id = update.message.chat_id
     user = update.message.from_user
@@ -599,6 +1572,7 @@ def skip_title_handler(update, context):
     return DESCRIPTION
 
 
+@synchronized
 def skip_description_handler(update, context):
     chat_id = update.message.chat_id
     user = update.message.from_user
@@ -612,145 +1586,111 @@ def skip_description_handler(update, context):
     return REWARD
 
 
+@synchronized
 def remove_title_handler(update, context):
     user = update.message.from_user
-    quest_id = context.user_data["current_quest"]
     chat_id = update.message.chat_id
 
     if not check_profile_existence(user.id):
         send_message(chat_id, "You don't have a sidequest board yet! Make one using /am.")
         return ConversationHandler.END
 
-    sidequest_database["sidequests"][user.id][quest_id][0] = ""
+    quest = get_edited_quest(context, user.id)
+    if quest is None:
+        return end_lost_editor(update, context)
+
+    quest[0] = ""
 
     update.message.reply_text("Alright, the title has been removed! Now send me some text for the description, use /skipdesc, or use /removedesc.")
 
     return DESCRIPTION
 
 
+@synchronized
 def remove_description_handler(update, context):
     user = update.message.from_user
-    quest_id = context.user_data["current_quest"]
     chat_id = update.message.chat_id
 
     if not check_profile_existence(user.id):
         send_message(chat_id, "You don't have a sidequest board yet! Make one using /am.")
         return ConversationHandler.END
 
-    sidequest_database["sidequests"][user.id][quest_id][1] = ""
+    quest = get_edited_quest(context, user.id)
+    if quest is None:
+        return end_lost_editor(update, context)
+
+    quest[1] = ""
 
     update.message.reply_text("That description has been removed! Lastly, you need to send some text for the reward, use /skipreward, or use /removereward.")
 
     return REWARD
 
 
+@synchronized
 def add_reward_handler(update, context):
     user = update.message.from_user
     reward = update.message.text
-    quest_id = context.user_data["current_quest"]
     chat_id = update.message.chat_id
 
     if not check_profile_existence(user.id):
         send_message(chat_id, "You don't have a sidequest board yet! Make one using /am.")
         return ConversationHandler.END
 
-    sidequest_database["sidequests"][user.id][quest_id][2] = reward
-
-    update.message.reply_text("Thanks! You're all done!")
-
-    text = "%s has added a new sidequest:" % get_name_from_database(user.id)
-    title = sidequest_database["sidequests"][user.id][quest_id][0]
-    buttons = []
+    quest = get_edited_quest(context, user.id)
+    if quest is None:
+        return end_lost_editor(update, context)
 
-    buttons.append(
-        [
-            # Callback data for show is:
-            # [SHOW (header), Sidequest Giver Telegram ID, Sidequest ID]
-            telegram.InlineKeyboardButton(text=title if title != "" else "[NO TITLE]",
-                                          callback_data="SHOW,%s,%s" % (user.id, quest_id))
-        ]
-    )
-    buttons.append(
-        [
-            # Callback data for listing the accepters is:
-            # [LIST (header), Sidequest Owner Telegram ID, Sidequest ID]
-            telegram.InlineKeyboardButton(text="≡ (0)",
-                                          callback_data="LIST,%s,%s" % (user.id, quest_id)),
-            # Callback data for toggle is:
-            # [TOGGLE (header), Sidequest Giver Telegram ID, Sidequest ID]
-            telegram.InlineKeyboardButton(text="⬜", callback_data="TOGGLE,%s,%s" % (user.id, quest_id))
-        ]
-    )
+    quest[2] = reward
 
-    for id, name in sidequest_database["users"]:
-        if id != user.id:
-            bot.send_message(chat_id=id,
-                             text=text,
-                             reply_markup=telegram.InlineKeyboardMarkup(buttons),
-                             parse_mode=telegram.ParseMode.HTML)
+    update.message.reply_text("Thanks! You're all done!")
 
+    finish_editing(context, user.id)
     return ConversationHandler.END
 
 
+@synchronized
 def skip_reward_handler(update, context):
     chat_id = update.message.chat_id
     user = update.message.from_user
-    quest_id = context.user_data["current_quest"]
 
     if not check_profile_existence(user.id):
         send_message(chat_id, "You don't have a sidequest board yet! Make one using /am.")
         return ConversationHandler.END
 
-    update.message.reply_text("No reward added. You're all done!")
-
-    text = "%s has added a new sidequest:" % get_name_from_database(user.id)
-    title = sidequest_database["sidequests"][user.id][quest_id][0]
-    buttons = []
-
-    buttons.append(
-        [
-            # Callback data for show is:
-            # [SHOW (header), Sidequest Giver Telegram ID, Sidequest ID]
-            telegram.InlineKeyboardButton(text=title if title != "" else "[NO TITLE]",
-                                          callback_data="SHOW,%s,%s" % (user.id, quest_id))
-        ]
-    )
-    buttons.append(
-        [
-            # Callback data for listing the accepters is:
-            # [LIST (header), Sidequest Owner Telegram ID, Sidequest ID]
-            telegram.InlineKeyboardButton(text="≡ (0)",
-                                          callback_data="LIST,%s,%s" % (user.id, quest_id)),
-            # Callback data for toggle is:
-            # [TOGGLE (header), Sidequest Giver Telegram ID, Sidequest ID]
-            telegram.InlineKeyboardButton(text="⬜", callback_data="TOGGLE,%s,%s" % (user.id, quest_id))
-        ]
-    )
+    if get_edited_quest(context, user.id) is None:
+        return end_lost_editor(update, context)
 
-    for id, name in sidequest_database["users"]:
-        if id != user.id:
-            bot.send_message(chat_id=id,
-                             text=text,
-                             reply_markup=telegram.InlineKeyboardMarkup(buttons),
-                             parse_mode=telegram.ParseMode.HTML)
+    update.message.reply_text("No reward added. You're all done!")
 
+    finish_editing(context, user.id)
     return ConversationHandler.END
 
 
+@synchronized
 def remove_reward_handler(update, context):
     user = update.message.from_user
-    quest_id = context.user_data["current_quest"]
 
     if not check_profile_existence(user.id):
         send_message(user.id, "You don't have a sidequest board yet! Make one using /am.")
         return ConversationHandler.END
 
-    sidequest_database["sidequests"][user.id][quest_id][2] = ""
+    quest = get_edited_quest(context, user.id)
+    if quest is None:
+        return end_lost_editor(update, context)
+
+    quest[2] = ""
 
     update.message.reply_text("The reward has been removed. You're all done!")
 
-    text = "%s has added a new sidequest:" % get_name_from_database(user.id)
-    title = sidequest_database["sidequests"][user.id][quest_id][0]
+    finish_editing(context, user.id)
+    return ConversationHandler.END
+
+
+def make_announcement(questgiver_id, quest_id):
+    # Builds the new sidequest announcement once. The keyboard is serialized up front so the same
+    # payload can be sent to every recipient as is.
+    text = "%s has added a new sidequest:" % get_name_from_database(questgiver_id)
+    title = sidequest_database["sidequests"][questgiver_id][quest_id][0]
     buttons = []
 
     buttons.append(
@@ -758,7 +1698,7 @@ def remove_reward_handler(update, context):
             # Callback data for show is:
             # [SHOW (header), Sidequest Giver Telegram ID, Sidequest ID]
             telegram.InlineKeyboardButton(text=title if title != "" else "[NO TITLE]",
-                                          callback_data="SHOW,%s,%s" % (user.id, quest_id))
+                                          callback_data="SHOW,%s,%s" % (questgiver_id, quest_id))
         ]
     )
     buttons.append(
@@ -766,21 +1706,41 @@ def remove_reward_handler(update, context):
             # Callback data for listing the accepters is:
             # [LIST (header), Sidequest Owner Telegram ID, Sidequest ID]
             telegram.InlineKeyboardButton(text="≡ (0)",
-                                          callback_data="LIST,%s,%s" % (user.id, quest_id)),
+                                          callback_data="LIST,%s,%s" % (questgiver_id, quest_id)),
             # Callback data for toggle is:
             # [TOGGLE (header), Sidequest Giver Telegram ID, Sidequest ID]
-            telegram.InlineKeyboardButton(text="⬜", callback_data="TOGGLE,%s,%s" % (user.id, quest_id))
+            telegram.InlineKeyboardButton(text="⬜", callback_data="TOGGLE,%s,%s" % (questgiver_id, quest_id))
         ]
     )
 
-    for id, name in sidequest_database["users"]:
-        if id != user.id:
+    return text, telegram.InlineKeyboardMarkup(buttons).to_json()
+
+
+def get_announcement_recipients(questgiver_id):
+    # Subscribers who share a namespace with the questgiver get the announcement, as do the questgiver's followers,
+    # so this only touches the questgiver's namespaces and followers.
+    subscribers = sidequest_database["subscribers"]
+    recipients = set(id for id in get_scope_members(sidequest_database["memberships"].get(questgiver_id, ()))
+                     if id in subscribers)
+    recipients.update(sidequest_database["followers"].get(questgiver_id, ()))
+    recipients.discard(questgiver_id)
+
+    return filter_recipients(recipients)
+
+
+def announce_sidequest(questgiver_id, quest_id):
+    text, reply_markup = make_announcement(questgiver_id, quest_id)
+
+    for id, silent in get_announcement_recipients(questgiver_id):
+        try:
             bot.send_message(chat_id=id,
                              text=text,
-                             reply_markup=telegram.InlineKeyboardMarkup(buttons),
-                             parse_mode=telegram.ParseMode.HTML)
-
-    return ConversationHandler.END
+                             reply_markup=reply_markup,
+                             parse_mode=telegram.ParseMode.HTML,
+                             disable_notification=silent)
+        except Unauthorized:
+            # They've blocked the bot; don't let that stop everyone else's announcement.
+            continue
 
 
 def cancel_handler(update, context):
@@ -793,6 +1753,10 @@ def cancel_handler(update, context):
 
     send_message(chat_id, "Exited from sidequest creator!")
 
+    # An unfinished new sidequest is simply dropped.
+    context.user_data.pop("draft", None)
+    context.user_data.pop("current_quest", None)
+    context.user_data.pop("editing_since", None)
     return ConversationHandler.END
 
 
@@ -804,9 +1768,258 @@ def archives_handler(update, context):
         send_message(user.id, "You don't have a sidequest board yet! Make one using /am.")
         return
 
-    send_message(chat_id, "<b>Your Archived Sidequests:</b>")
-    for title, description, reward, accepters in sidequest_database["archives"][user.id]:
-        send_message(chat_id, "<b>Title:</b> %s" % title + "\n\n<b>Description:</b> %s" % description + "\n\n<b>Reward:</b> %s" % reward + "\n\n<b>Accepters:</b> %s" % ",".join(accepters))
+    if len(context.args) > 1:
+        send_message(chat_id, "Usage: /archives [page]")
+        return
+
+    try:
+        page = int(context.args[0]) - 1 if len(context.args) == 1 else 0
+    except ValueError:
+        send_message(chat_id, "Usage: /archives [page]")
+        return
+
+    text, buttons = make_archives_page(user.id, page)
+
+    bot.send_message(chat_id=chat_id,
+                     text=text,
+                     reply_markup=telegram.InlineKeyboardMarkup(buttons),
+                     parse_mode=telegram.ParseMode.HTML)
+
+
+@synchronized
+def leave_handler(update, context):
+    chat_id = update.message.chat.id
+    user = update.message.from_user
+
+    namespace = chat_id if update.message.chat.type != telegram.Chat.PRIVATE else GLOBAL_NAMESPACE
+
+    if user.id not in sidequest_database["namespaces"].get(namespace, ()):
+        send_message(chat_id, "You aren't on this board!")
+        return
+
+    leave_namespace(user.id, namespace)
+
+    send_message(chat_id, "You've left this board. Your sidequests are still there for anyone else you share a board with.")
+
+
+@synchronized
+def subscribe_handler(update, context):
+    chat_id = update.message.chat.id
+    user = update.message.from_user
+
+    if not check_profile_existence(user.id):
+        send_message(chat_id, "You don't have a sidequest board yet! Make one using /am.")
+        return
+
+    sidequest_database["subscribers"].add(user.id)
+
+    send_message(chat_id, "You'll now be told about every new sidequest!")
+
+
+@synchronized
+def unsubscribe_handler(update, context):
+    chat_id = update.message.chat.id
+    user = update.message.from_user
+
+    if not check_profile_existence(user.id):
+        send_message(chat_id, "You don't have a sidequest board yet! Make one using /am.")
+        return
+
+    sidequest_database["subscribers"].discard(user.id)
+
+    send_message(chat_id, "You won't be told about new sidequests anymore. Use /subscribe to change your mind.")
+
+
+@synchronized
+def follow_handler(update, context):
+    chat_id = update.message.chat.id
+    user = update.message.from_user
+
+    if not check_profile_existence(user.id):
+        send_message(chat_id, "You don't have a sidequest board yet! Make one using /am.")
+        return
+
+    if len(context.args) == 0:
+        following = sidequest_database["following"].get(user.id, set())
+        if len(following) == 0:
+            send_message(chat_id, "You aren't following anyone! Use /follow [name] to start.")
+        else:
+            send_message(chat_id, "You're following:\n\n" + "\n".join(sorted(get_name_from_database(id) for id in following)))
+        return
+
+    questgiver_id = find_user_id(" ".join(context.args), get_scope(update.message.chat, user.id))
+    if questgiver_id is None:
+        send_message(chat_id, "Error: Could not find a matching name!")
+        return
+
+    if questgiver_id == user.id:
+        send_message(chat_id, "You can't follow yourself!")
+        return
+
+    follow(user.id, questgiver_id)
+
+    text = "You'll now be told whenever %s adds a sidequest!" % get_name_from_database(questgiver_id)
+    if user.id in sidequest_database["subscribers"]:
+        text += " You're still subscribed to every sidequest, so use /unsubscribe to only hear from people you follow."
+    send_message(chat_id, text)
+
+
+@synchronized
+def unfollow_handler(update, context):
+    chat_id = update.message.chat.id
+    user = update.message.from_user
+
+    if not check_profile_existence(user.id):
+        send_message(chat_id, "You don't have a sidequest board yet! Make one using /am.")
+        return
+
+    if len(context.args) == 0:
+        send_message(chat_id, "Usage: /unfollow [name]")
+        return
+
+    questgiver_id = find_user_id(" ".join(context.args), get_scope(update.message.chat, user.id))
+    if questgiver_id is None or questgiver_id not in sidequest_database["following"].get(user.id, set()):
+        send_message(chat_id, "Error: You aren't following anyone with that name!")
+        return
+
+    unfollow(user.id, questgiver_id)
+
+    send_message(chat_id, "You've unfollowed %s." % get_name_from_database(questgiver_id))
+
+
+@synchronized
+def mute_handler(update, context):
+    chat_id = update.message.chat.id
+    user = update.message.from_user
+
+    if not check_profile_existence(user.id):
+        send_message(chat_id, "You don't have a sidequest board yet! Make one using /am.")
+        return
+
+    settings = dict(get_notification_settings(user.id))
+    settings["muted"] = not settings["muted"]
+    sidequest_database["notifications"][user.id] = settings
+
+    if settings["muted"]:
+        send_message(chat_id, "Announcements are muted. Use /mute again to unmute them.")
+    else:
+        send_message(chat_id, "Announcements are unmuted!")
+
+
+@synchronized
+def quiet_hours_handler(update, context):
+    chat_id = update.message.chat.id
+    user = update.message.from_user
+
+    if not check_profile_existence(user.id):
+        send_message(chat_id, "You don't have a sidequest board yet! Make one using /am.")
+        return
+
+    settings = dict(get_notification_settings(user.id))
+
+    if len(context.args) == 1 and context.args[0].lower() == "off":
+        settings["quiet_hours"] = None
+        sidequest_database["notifications"][user.id] = settings
+        send_message(chat_id, "Quiet hours are off.")
+        return
+
+    try:
+        start, end = [int(arg) for arg in context.args]
+    except ValueError:
+        start, end = -1, -1
+
+    if len(context.args) != 2 or not (0 <= start < 24 and 0 <= end < 24) or start == end:
+        send_message(chat_id, "Usage: /quiet {start hour} {end hour} in UTC (0-23), or /quiet off")
+        return
+
+    settings["quiet_hours"] = (start, end)
+    sidequest_database["notifications"][user.id] = settings
+
+    send_message(chat_id, "Announcements between %s:00 and %s:00 UTC will arrive silently. It's %s UTC now." %
+                 (start, end, datetime.datetime.utcnow().strftime("%H:%M")))
+
+
+@synchronized
+def deadline_handler(update, context):
+    chat_id = update.message.chat.id
+    user = update.message.from_user
+
+    if not check_profile_existence(user.id):
+        send_message(chat_id, "You don't have a sidequest board yet! Make one using /am.")
+        return
+
+    board = sidequest_database["sidequests"][user.id]
+
+    try:
+        quest_id = int(context.args[0]) - 1
+        hours = None if context.args[1].lower() == "off" else float(context.args[1])
+    except (IndexError, ValueError):
+        send_message(chat_id, "Usage: /deadline {sidequest number from /display} {hours from now, or off}")
+        return
+
+    if len(context.args) != 2 or quest_id < 0 or quest_id >= len(board):
+        send_message(chat_id, "Usage: /deadline {sidequest number from /display} {hours from now, or off}")
+        return
+
+    # float() also accepts nan and inf. A NaN deadline would sit at the top of EXPIRY_HEAP forever and stop every
+    # other sidequest from expiring, so check before touching the board.
+    if hours is not None and not (math.isfinite(hours) and 0 < hours <= DEADLINE_MAX_HOURS):
+        send_message(chat_id, "The deadline has to be more than 0 and at most %s hours from now." % DEADLINE_MAX_HOURS)
+        return
+
+    if hours is None:
+        board[quest_id][4] = None
+        send_message(chat_id, "That sidequest no longer has a deadline.")
+        return
+
+    board[quest_id][4] = time.time() + hours * 3600
+    schedule_expiry(user.id, board[quest_id][4])
+
+    send_message(chat_id, "That sidequest will be archived on %s." % format_deadline(board[quest_id][4]))
+
+
+def stats_handler(update, context):
+    chat_id = update.message.chat.id
+    user = update.message.from_user
+
+    if not check_profile_existence(user.id):
+        send_message(chat_id, "You don't have a sidequest board yet! Make one using /am.")
+        return
+
+    # Ranks are among the people who share this chat's namespaces, like /leaderboard.
+    accepted_leaderboards, popularity_leaderboards = get_scope_leaderboards(get_scope(update.message.chat, user.id))
+    accepted_rank = scope_rank(accepted_leaderboards, user.id, ACCEPTED_LEADERBOARD.get(user.id))
+    popularity_rank = scope_rank(popularity_leaderboards, user.id, POPULARITY_LEADERBOARD.get(user.id))
+
+    send_message(chat_id, "<b>Stats for %s:</b>\n\n" % get_name_from_database(user.id) +
+                 "Open sidequests: %s\n" % len(sidequest_database["sidequests"].peek(user.id)) +
+                 "Sidequests accepted: %s%s\n" % (ACCEPTED_LEADERBOARD.get(user.id),
+                                                    " (#%s)" % accepted_rank if accepted_rank is not None else "") +
+                 "Accepters on your sidequests: %s%s" % (POPULARITY_LEADERBOARD.get(user.id),
+                                                          " (#%s)" % popularity_rank if popularity_rank is not None else ""))
+
+
+def leaderboard_handler(update, context):
+    chat_id = update.message.chat.id
+
+    try:
+        k = int(context.args[0]) if len(context.args) > 0 else LEADERBOARD_DEFAULT_SIZE
+    except ValueError:
+        send_message(chat_id, "Usage: /leaderboard [number of places]")
+        return
+
+    k = min(max(k, 1), LEADERBOARD_MAX_SIZE)
+    accepted_leaderboards, popularity_leaderboards = get_scope_leaderboards(get_scope(update.message.chat, update.message.from_user.id))
+
+    text = "<b>Most sidequests accepted:</b>\n"
+    for place, (telegram_id, count) in enumerate(scope_top(accepted_leaderboards, k)):
+        text += "%s. %s (%s)\n" % (place + 1, get_name_from_database(telegram_id), count)
+
+    text += "\n<b>Most popular questgivers:</b>\n"
+    for place, (telegram_id, count) in enumerate(scope_top(popularity_leaderboards, k)):
+        text += "%s. %s (%s)\n" % (place + 1, get_name_from_database(telegram_id), count)
+
+    send_message(chat_id, text)
 
 
 def feedback_handler(update, context):
@@ -819,49 +2032,1072 @@ def feedback_handler(update, context):
             break
 
     if context.args and len(context.args) > 0:
-        feedback = open("feedback.txt", "a+")
-
-        feedback.write(str(update.message.from_user.id) +
-                       " (" + username + ") at " +
-                       str(datetime.datetime.now()) + "\n")
-        feedback.write(" ".join(context.args) + "\n\n")
-
-        feedback.close()
+        FEEDBACK_LOGGER.info(" ".join(context.args), extra={"fields": {"user_id": user.id, "name": username}})
 
         send_message(update.message.chat_id, text="Your response has been recorded!")
     else:
         send_message(update.message.chat_id, text="Error: You must input a non-empty string.")
 
 
+def export_records():
+    # Streams the database one JSON Lines record at a time. Sidequests are grouped by questgiver, and users come
+    # first so an import can check accepters and follows against them. The export runs alongside the handlers, so
+    # each record's data is copied under DATABASE_LOCK, but the lock isn't held for the whole export.
+    with DATABASE_LOCK:
+        users = list(sidequest_database["users"])
+
+    for telegram_id, name in users:
+        with DATABASE_LOCK:
+            settings = get_notification_settings(telegram_id)
+            record = {"type": "user", "id": telegram_id, "name": name,
+                      "subscribed": telegram_id in sidequest_database["subscribers"],
+                      "following": sorted(sidequest_database["following"].get(telegram_id, set())),
+                      "muted": settings["muted"],
+                      "quiet_hours": settings["quiet_hours"],
+                      "namespaces": sorted(sidequest_database["memberships"].get(telegram_id, set())),
+                      "last_seen": sidequest_database["last_seen"].get(telegram_id)}
+        yield record
+
+    for questgiver_id in sidequest_database["sidequests"].keys():
+        with DATABASE_LOCK:
+            board = copy.deepcopy(sidequest_database["sidequests"].peek(questgiver_id))
+        for title, description, reward, accepters, deadline in board:
+            yield {"type": "sidequest", "questgiver": questgiver_id, "title": title,
+                   "description": description, "reward": reward, "accepters": accepters, "deadline": deadline}
+
+    for questgiver_id in get_archived_ids():
+        for title, description, reward, accepters in iter_archive(questgiver_id):
+            yield {"type": "archive", "questgiver": questgiver_id, "title": title,
+                   "description": description, "reward": reward, "accepters": accepters}
+
+    with DATABASE_LOCK:
+        patches = list(sidequest_database["patches"])
+
+    for patch in patches:
+        yield {"type": "patch", "patch": patch}
+
+
+def export_database(path):
+    count = 0
+    with open(path, "w", encoding="utf-8") as f:
+        for record in export_records():
+            f.write(json.dumps(record, ensure_ascii=False) + "\n")
+            count += 1
+    return count
+
+
+def import_database(path):
+    # Adds every record in a JSON Lines export to the current database. Returns the number of records imported.
+    # Imports are idempotent: users and patches that already exist are skipped, and so are the sidequests and
+    # archives of anyone who already had a board or an archive before the import, so running the same import
+    # twice (or importing a backup into a live database) doesn't duplicate anything.
+    count = 0
+    user_ids = set(id for id, name in sidequest_database["users"])
+    patches = set(sidequest_database["patches"])
+    existing_boards = set(id for id in sidequest_database["sidequests"].keys() if len(sidequest_database["sidequests"].peek(id)) > 0)
+    existing_archives = set(get_archived_ids())
+    # Follows are applied at the end, once every user in the file is known.
+    pending_follows = []
+
+    # Consecutive sidequests for the same questgiver are buffered so each board is written once.
+    pending_id = None
+    pending_quests = []
+
+    # A bad line stops the import, but everything before it is kept, so the rest of the import still has to be
+    # finished off. Running it again once the file is fixed skips what was already imported.
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            for line_number, line in enumerate(f, 1):
+                if line.strip() == "":
+                    continue
+                record = json.loads(line)
+
+                if record["type"] == "sidequest":
+                    questgiver_id = record["questgiver"]
+                    if questgiver_id in existing_boards or questgiver_id not in user_ids:
+                        continue
+                    if questgiver_id != pending_id:
+                        if len(pending_quests) > 0:
+                            sidequest_database["sidequests"].extend_cold(pending_id, pending_quests)
+                        pending_id = questgiver_id
+                        pending_quests = []
+                    # Same rules as accepting a sidequest: registered, not the questgiver, and only once.
+                    accepters = []
+                    for accepter in record["accepters"]:
+                        if accepter in user_ids and accepter != questgiver_id and accepter not in accepters:
+                            accepters.append(accepter)
+                    # json.loads accepts NaN and Infinity, and neither they nor anything further off than /deadline
+                    # allows can be scheduled or shown.
+                    deadline = record.get("deadline")
+                    if deadline is not None and not (math.isfinite(deadline) and deadline <= time.time() + DEADLINE_MAX_HOURS * 3600):
+                        deadline = None
+                    pending_quests.append([record["title"], record["description"], record["reward"], accepters, deadline])
+                elif record["type"] == "user":
+                    if record["id"] in user_ids:
+                        continue
+                    user_ids.add(record["id"])
+                    sidequest_database["users"].append((record["id"], record["name"]))
+                    USER_NAMES[record["id"]] = record["name"]
+                    sidequest_database["last_seen"][record["id"]] = record.get("last_seen") or time.time()
+                    for namespace in record.get("namespaces", [GLOBAL_NAMESPACE]):
+                        join_namespace(record["id"], namespace)
+                    # Exports from before subscriptions existed have no "subscribed", and everyone was subscribed then.
+                    if record.get("subscribed", True):
+                        sidequest_database["subscribers"].add(record["id"])
+                    for questgiver_id in record.get("following", []):
+                        pending_follows.append((record["id"], questgiver_id))
+                    if record.get("muted", False) or record.get("quiet_hours") is not None:
+                        sidequest_database["notifications"][record["id"]] = {
+                            "muted": record.get("muted", False),
+                            "quiet_hours": tuple(record["quiet_hours"]) if record.get("quiet_hours") is not None else None}
+                elif record["type"] == "archive":
+                    if record["questgiver"] in existing_archives:
+                        continue
+                    append_archive(record["questgiver"], [record["title"], record["description"], record["reward"], record["accepters"]])
+                elif record["type"] == "patch":
+                    if record["patch"] in patches:
+                        continue
+                    patches.add(record["patch"])
+                    sidequest_database["patches"].append(record["patch"])
+                else:
+                    raise ValueError("Unknown record type %s on line %s" % (record["type"], line_number))
+
+                count += 1
+    finally:
+        if len(pending_quests) > 0:
+            sidequest_database["sidequests"].extend_cold(pending_id, pending_quests)
+
+        for follower_id, questgiver_id in pending_follows:
+            if questgiver_id in user_ids and questgiver_id != follower_id:
+                follow(follower_id, questgiver_id)
+
+        # Sort by name
+        sidequest_database["users"] = sorted(sidequest_database["users"], key=lambda x: str(x[1]).lower())
+
+        reconcile_leaderboards()
+        rebuild_expiry_heap()
+
+    return count
+
+
+@restricted
+def export_handler(update, context):
+    chat_id = update.message.chat.id
+
+    os.makedirs(EXPORT_DIRECTORY, exist_ok=True)
+    path = os.path.join(EXPORT_DIRECTORY, "sidequests_%s.jsonl" % datetime.datetime.now().strftime("%Y%m%d%H%M%S"))
+
+    start = time.time()
+    count = export_database(path)
+
+    send_message(chat_id, "Exported %s records to %s in %.2fs." % (count, path, time.time() - start))
+
+    try:
+        with open(path, "rb") as f:
+            bot.send_document(chat_id=chat_id, document=f)
+    except TelegramError:
+        send_message(chat_id, "The export was too large to send, but it's still on the server.")
+
+
+@restricted
+@synchronized
+def import_handler(update, context):
+    chat_id = update.message.chat.id
+
+    if len(context.args) != 1:
+        send_message(chat_id, "Usage: /import {path to a .jsonl export on the server}")
+        return
+
+    if not os.path.isfile(context.args[0]):
+        send_message(chat_id, "Error: Could not find %s!" % context.args[0])
+        return
+
+    start = time.time()
+    try:
+        count = import_database(context.args[0])
+    except (ValueError, KeyError, TypeError) as e:
+        save_database(context)
+        send_message(chat_id, "Error: The import stopped partway through, keeping what came before: %s" % e)
+        return
+
+    save_database(context)
+
+    send_message(chat_id, "Imported %s records in %.2fs." % (count, time.time() - start))
+
+
+# Min-heap of (deadline, questgiver_id). Entries are never removed when a deadline changes; a stale entry just
+# causes an extra check of that board.
+EXPIRY_HEAP = []
+EXPIRY_LOCK = RLock()
+
+
+def schedule_expiry(questgiver_id, deadline):
+    with EXPIRY_LOCK:
+        heapq.heappush(EXPIRY_HEAP, (deadline, questgiver_id))
+
+
+def rebuild_expiry_heap():
+    entries = []
+    store = sidequest_database["sidequests"]
+    for questgiver_id in store.keys():
+        for quest in store.peek(questgiver_id):
+            if quest[4] is not None:
+                entries.append((quest[4], questgiver_id))
+
+        # Deadlines saved before they were checked could be NaN or infinite, which would jam the heap.
+        if any(quest[4] is not None and not math.isfinite(quest[4]) for quest in store.peek(questgiver_id)):
+            for quest in store[questgiver_id]:
+                if quest[4] is not None and not math.isfinite(quest[4]):
+                    quest[4] = None
+            entries = [entry for entry in entries if math.isfinite(entry[0])]
+
+    heapq.heapify(entries)
+    with EXPIRY_LOCK:
+        EXPIRY_HEAP[:] = entries
+
+
+def is_editing(dispatcher, telegram_id):
+    # Boards with an open editor are left alone, since removing a sidequest would shift the one being edited.
+    editing_since = dispatcher.user_data.get(telegram_id, {}).get("editing_since")
+    return editing_since is not None and time.time() - editing_since < EDITOR_TIMEOUT_SECONDS
+
+
+# (telegram_id, text) waiting to be sent by notification_worker.
+NOTIFICATION_QUEUE = queue.Queue()
+
+
+def notification_worker():
+    # Sends queued notifications one at a time, NOTIFICATION_INTERVAL apart, so a big batch doesn't hit Telegram's
+    # rate limit or hold up whichever handler or job queued it.
+    while True:
+        telegram_id, text = NOTIFICATION_QUEUE.get()
+        try:
+            send_message(telegram_id, text)
+        except TelegramError as e:
+            ERROR_LOGGER.warning("Could not send a notification.", extra={"fields": {"telegram_id": telegram_id,
+                                                                                     "error": repr(e)}})
+        finally:
+            NOTIFICATION_QUEUE.task_done()
+
+        if NOTIFICATION_INTERVAL > 0:
+            time.sleep(NOTIFICATION_INTERVAL)
+
+
+NOTIFICATION_WORKER = None
+
+
+def start_notification_worker():
+    # Started by the bot and the offline dispatcher rather than on import, so the command line tools don't run one.
+    global NOTIFICATION_WORKER
+    if NOTIFICATION_WORKER is None:
+        NOTIFICATION_WORKER = Thread(target=notification_worker, name="notification_worker", daemon=True)
+        NOTIFICATION_WORKER.start()
+
+
+def drain_notifications(timeout):
+    # Waits up to timeout seconds for the queue to empty, since the worker is a daemon thread and anything still
+    # queued when the process exits (or execs on /restart) is lost. Whatever doesn't make it is logged.
+    if NOTIFICATION_WORKER is None:
+        return
+
+    deadline = time.time() + timeout
+    with NOTIFICATION_QUEUE.all_tasks_done:
+        while NOTIFICATION_QUEUE.unfinished_tasks > 0 and time.time() < deadline:
+            NOTIFICATION_QUEUE.all_tasks_done.wait(deadline - time.time())
+        unsent = NOTIFICATION_QUEUE.unfinished_tasks
+
+    if unsent > 0:
+        ERROR_LOGGER.warning("Notifications were still queued when the bot stopped.", extra={"fields": {"unsent": unsent}})
+
+
+def send_batched(notifications, header):
+    # Queues a single message for each person listing everything that happened to them.
+    for telegram_id, lines in notifications.items():
+        NOTIFICATION_QUEUE.put((telegram_id, header + "\n\n" + "\n".join(lines)))
+
+
+@synchronized
+def expire_sidequests_job(context):
+    now = time.time()
+    due = set()
+
+    with EXPIRY_LOCK:
+        while len(EXPIRY_HEAP) > 0 and EXPIRY_HEAP[0][0] <= now:
+            due.add(heapq.heappop(EXPIRY_HEAP)[1])
+
+    notifications = defaultdict(list)
+    count = 0
+
+    for questgiver_id in due:
+        if questgiver_id not in sidequest_database["sidequests"]:
+            continue
+
+        if is_editing(context.dispatcher, questgiver_id):
+            schedule_expiry(questgiver_id, now + EXPIRY_CHECK_SECONDS)
+            continue
+
+        board = sidequest_database["sidequests"][questgiver_id]
+        expired = [quest for quest in board if quest[4] is not None and quest[4] <= now]
+        if len(expired) == 0:
+            continue
+
+        board[:] = [quest for quest in board if quest[4] is None or quest[4] > now]
+
+        name = get_name_from_database(questgiver_id)
+        for quest in expired:
+            append_archive(questgiver_id, quest)
+            count_removed_sidequest(questgiver_id, quest)
+            notifications[questgiver_id].append("%s (yours)" % quest[0])
+            for accepter in quest[3]:
+                notifications[accepter].append("%s by %s" % (quest[0], name))
+        count += len(expired)
+
+    if count > 0:
+        send_batched(notifications, "These sidequests passed their deadline and were archived:")
+        JOB_LOGGER.info("Archived expired sidequests.", extra={"fields": {"count": count, "boards": len(due)}})
+
+    if DEBUG_INVARIANTS:
+        report_violations(check_invariants(due), "expire_sidequests_job")
+
+
+@synchronized
+def purge_drafts_job(context):
+    # Drafts of new sidequests live in user_data until they're finished. Drop the ones whose editor has been
+    # abandoned; if that person comes back to the editor, it tells them the sidequest is gone.
+    cutoff = time.time() - EDITOR_TIMEOUT_SECONDS
+    count = 0
+
+    # Handlers on other threads can add user_data entries while this runs, so iterate over a copy.
+    for telegram_id, user_data in list(context.dispatcher.user_data.items()):
+        if "draft" in user_data and user_data.get("editing_since", 0) < cutoff:
+            user_data.pop("draft", None)
+            user_data.pop("editing_since", None)
+            count += 1
+
+    if count > 0:
+        if context.dispatcher.persistence is not None:
+            context.dispatcher.update_persistence()
+        JOB_LOGGER.info("Purged abandoned drafts.", extra={"fields": {"count": count}})
+
+    if DEBUG_INVARIANTS:
+        report_violations(check_invariants(), "purge_drafts_job")
+
+
+@restricted
+@synchronized
+def bulk_handler(update, context):
+    chat_id = update.message.chat.id
+    usage = ("Usage:\n/bulk ban inactive {days}\n/bulk purge|archive unaccepted\n/bulk purge|archive inactive {days}\n\n"
+             "inactive means the questgiver hasn't used the bot in that many days.")
+
+    if len(context.args) < 2 or context.args[0] not in ("ban", "purge", "archive") or \
+            context.args[1] not in ("inactive", "unaccepted") or (context.args[0] == "ban" and context.args[1] != "inactive"):
+        send_message(chat_id, usage)
+        return
+
+    action, condition = context.args[0], context.args[1]
+
+    days = None
+    if condition == "inactive":
+        try:
+            days = float(context.args[2])
+        except (IndexError, ValueError):
+            send_message(chat_id, usage)
+            return
+
+    start = time.time()
+    notifications = defaultdict(list)
+
+    if action == "ban":
+        inactive = get_inactive_users(days)
+        for telegram_id in inactive:
+            notifications[telegram_id].append("You haven't used the bot in %s days. Use /am to join again." % context.args[2])
+        deleted, accepts = remove_users(inactive)
+        text = "Removed %s users, %s of their sidequests and %s of their accepts" % (len(inactive), deleted, accepts)
+        header = "You've been removed from the sidequest board."
+    else:
+        if condition == "inactive":
+            inactive = get_inactive_users(days)
+            matches = lambda questgiver_id, quest: questgiver_id in inactive
+        else:
+            matches = lambda questgiver_id, quest: len(quest[3]) == 0
+
+        removed, boards = remove_sidequests(matches, context.dispatcher, archive=action == "archive")
+        for questgiver_id, quest in removed:
+            notifications[questgiver_id].append("%s (yours)" % quest[0])
+            for accepter in quest[3]:
+                notifications[accepter].append("%s by %s" % (quest[0], get_name_from_database(questgiver_id)))
+        text = "%s %s sidequests from %s boards" % ("Archived" if action == "archive" else "Deleted", len(removed), boards)
+        header = "An admin %s these sidequests:" % ("archived" if action == "archive" else "deleted")
+
+    send_batched(notifications, header)
+
+    elapsed = time.time() - start
+    send_message(chat_id, "%s in %.2fs. %s notifications are queued." % (text, elapsed, len(notifications)))
+    JOB_LOGGER.info("Ran a bulk operation.", extra={"fields": {"args": context.args, "result": text, "seconds": elapsed,
+                                                                "notifications": len(notifications)}})
+
+    if DEBUG_INVARIANTS:
+        report_violations(check_invariants(), "bulk_handler")
+
+
+PERSISTENCE = None
+
+
+@synchronized
 def save_database(context):
-    if os.path.exists("sidequestdatabase"):
-        shutil.copy("sidequestdatabase", "sidequestdatabasebackup")
-    pickle.dump(sidequest_database, open("sidequestdatabase", "wb"))
+    sidequest_database["sidequests"].evict_idle(BOARD_IDLE_SECONDS)
+
+    if os.path.exists(DATABASE_PATH):
+        shutil.copy(DATABASE_PATH, DATABASE_BACKUP_PATH)
+    write_snapshot(DATABASE_PATH, sidequest_database)
+
+    # Flush editor state at the same moment so it always matches the boards it points into.
+    if PERSISTENCE is not None:
+        PERSISTENCE.flush()
+
+
+# Schema version -> function that upgrades a database from the version before it, registered with @migrator.
+MIGRATORS = {}
+
+
+def migrator(version):
+    def register(func):
+        MIGRATORS[version] = func
+        return func
+    return register
+
+
+# Pickled databases don't say which of these they already have, so each migrator checks before changing anything.
+
+@migrator(1)
+def add_base_keys(database):
+    if database.get("sidequests") is None:
+        database["sidequests"] = BoardStore(BOARD_STORE_PATH)
+    elif not isinstance(database["sidequests"], BoardStore):
+        database["sidequests"] = BoardStore(BOARD_STORE_PATH, database["sidequests"])
+
+    if database.get("users") is None:
+        database["users"] = []
+
+    if database.get("patches") is None:
+        database["patches"] = []
+
+
+@migrator(2)
+def move_archives_to_logs(database):
+    # Archives used to be stored in the database as questgiver_id -> quest, so move them into the logs.
+    if database.get("archives") is not None:
+        for questgiver_id, archived in database.pop("archives").items():
+            if len(archived) > 0 and isinstance(archived[0], list):
+                for quest in archived:
+                    append_archive(questgiver_id, quest)
+            elif len(archived) > 0:
+                append_archive(questgiver_id, archived)
+
+
+@migrator(3)
+def add_subscribers(database):
+    # Everyone was told about every new sidequest before subscriptions existed.
+    if database.get("subscribers") is None:
+        database["subscribers"] = set(id for id, name in database["users"])
+
+
+@migrator(4)
+def add_follow_graph(database):
+    if database.get("following") is None:
+        database["following"] = {}
+
+    if database.get("followers") is None:
+        database["followers"] = {}
+
+    if database.get("notifications") is None:
+        database["notifications"] = {}
+
+
+@migrator(5)
+def add_deadlines(database):
+    # Sidequests used to be [title, description, reward, accepters] without a deadline.
+    store = database["sidequests"]
+    for telegram_id in store.keys():
+        if any(len(quest) == 4 for quest in store.peek(telegram_id)):
+            board = store[telegram_id]
+            for quest in board:
+                if len(quest) == 4:
+                    quest.append(None)
+
+
+@migrator(6)
+def add_namespaces(database):
+    # Everyone shared one board before namespaces.
+    if database.get("namespaces") is None:
+        database["namespaces"] = {GLOBAL_NAMESPACE: set(id for id, name in database["users"])}
+        database["memberships"] = {id: set([GLOBAL_NAMESPACE]) for id, name in database["users"]}
+
+
+@migrator(7)
+def add_last_seen(database):
+    # Nobody's activity was tracked before this, so everyone counts as seen when it's added.
+    if database.get("last_seen") is None:
+        now = time.time()
+        database["last_seen"] = {id: now for id, name in database["users"]}
+
+
+def init_database(database, version=0):
+    # Runs every migrator newer than the version the database was saved as (an empty database is version 0).
+    # Returns True if any ran, in which case the database should be saved right away.
+    for next_version in range(version + 1, SCHEMA_VERSION + 1):
+        MIGRATORS[next_version](database)
+
+    return version < SCHEMA_VERSION
 
 
 def handle_error(update, context):
     trace = "".join(traceback.format_tb(sys.exc_info()[2]))
-    ERROR_LOGGER.warning("Telegram Error! %s with context error %s caused by this update: %s", trace, context.error, update)
+    ERROR_LOGGER.warning("Telegram Error!", extra={"fields": {"trace": trace,
+                                                              "error": repr(context.error),
+                                                              "update": update.to_dict() if isinstance(update, telegram.Update) else update}})
 
 
-if __name__ == "__main__":
-    updater = Updater(token=TOKEN, use_context=True)
-    dispatcher = updater.dispatcher
+UPDATE_LOGGER = None
 
-    # Init setup
 
-    if sidequest_database.get("sidequests") is None:
-        sidequest_database["sidequests"] = defaultdict(list)
+def record_update(update, context):
+    global UPDATE_LOGGER
+    if UPDATE_LOGGER is None:
+        # The update log isn't rotated, since a replay needs the whole thing.
+        UPDATE_LOGGER = setup_logger("update_logger", UPDATE_LOG_PATH, formatter=logging.Formatter("%(message)s"), max_bytes=0)
+
+    UPDATE_LOGGER.info(json.dumps({"time": time.time(), "update": update.to_dict()},
+                                  ensure_ascii=False, separators=(",", ":")))
+
+
+class StubBot(telegram.Bot):
+    # Stands in for the real bot during replays. Nothing is sent to Telegram; calls are only counted.
+
+    def __init__(self, token):
+        super().__init__(token=token)
+        self.calls = defaultdict(int)
+
+    def get_me(self, *args, **kwargs):
+        return telegram.User(id=int(self.token.split(":")[0]), first_name="Sidequest Bot", is_bot=True,
+                             username="StubSidequestBot", bot=self)
+
+    def send_message(self, *args, **kwargs):
+        self.calls["send_message"] += 1
+
+    def send_photo(self, *args, **kwargs):
+        self.calls["send_photo"] += 1
+
+    def send_document(self, *args, **kwargs):
+        self.calls["send_document"] += 1
+
+    def edit_message_text(self, *args, **kwargs):
+        self.calls["edit_message_text"] += 1
+
+    def answer_callback_query(self, *args, **kwargs):
+        self.calls["answer_callback_query"] += 1
+
+
+def diff_databases(actual, expected):
+    differences = []
+
+    if actual["users"] != expected["users"]:
+        differences.append("Users differ: %s vs %s expected." % (len(actual["users"]), len(expected["users"])))
+
+    board_ids = set(actual["sidequests"].keys()) | set(expected["sidequests"].keys())
+    for telegram_id in sorted(board_ids):
+        actual_board = actual["sidequests"].peek(telegram_id)
+        expected_board = expected["sidequests"].peek(telegram_id)
+        if actual_board != expected_board:
+            differences.append("Board %s differs: %s sidequests vs %s expected." %
+                               (telegram_id, len(actual_board), len(expected_board)))
 
-    if sidequest_database.get("users") is None:
-        sidequest_database["users"] = []
+    return differences
 
-    if sidequest_database.get("patches") is None:
-        sidequest_database["patches"] = []
 
-    if sidequest_database.get("archives") is None:
-        sidequest_database["archives"] = defaultdict(list)
+def copy_database(database, store_path):
+    # Copies a loaded database into a new BoardStore at store_path so a replay can modify it without touching the
+    # bot's own files.
+    copied = {key: copy.deepcopy(value) for key, value in database.items() if key != "sidequests"}
+    store = database["sidequests"]
+    copied["sidequests"] = BoardStore(store_path,
+                                      {telegram_id: copy.deepcopy(store.peek(telegram_id)) for telegram_id in store.keys()})
+    return copied
 
+
+def read_snapshot_boards(reader):
+    # Every board in a snapshot, resident or cold, without opening the shelf it was saved from for writing.
+    section = reader.read_json("sidequests")
+    boards = {telegram_id: board for telegram_id, board in section["boards"]}
+
+    if "cold" in section:
+        boards.update((telegram_id, board) for telegram_id, board in section["cold"])
+        return boards
+
+    # Snapshots from before cold boards were saved with them only have the resident ones, so the rest come from the
+    # shelf as it is now, opened read-only so this still works next to a running bot.
+    if dbm.whichdb(section["path"]) is not None:
+        with shelve.open(section["path"], flag="r") as shelf:
+            for key in shelf.keys():
+                boards.setdefault(int(key), shelf[key])
+
+    return boards
+
+
+def load_database_copy(path, store_path):
+    # Loads a snapshot (or an old pickle) as a migrated copy with its boards in a new BoardStore at store_path.
+    if not is_snapshot(path):
+        database, version = load_database(path)
+        init_database(database, version)
+        return copy_database(database, store_path)
+
+    reader = SnapshotReader(path)
+    if reader.version > SCHEMA_VERSION:
+        raise ValueError("%s is schema version %s, but this bot only knows up to %s." % (path, reader.version, SCHEMA_VERSION))
+
+    database = {name: reader.read(name) for name in reader.sections if name != "sidequests"}
+    database["sidequests"] = BoardStore(store_path, read_snapshot_boards(reader))
+    init_database(database, reader.version)
+    return database
+
+
+def start_offline_dispatcher(snapshot=None):
+    # Sets up a dispatcher with every handler against a StubBot and a copy of the given snapshot (or an empty
+    # database) in a temporary directory, for replays and fuzzing.
+    global bot, sidequest_database, ARCHIVE_DIRECTORY, BOARD_STORE_PATH, NOTIFICATION_INTERVAL
+
+    # Nothing is really sent, so there's no rate limit to stay under.
+    NOTIFICATION_INTERVAL = 0
+
+    directory = tempfile.mkdtemp(prefix="sidequest_replay_")
+    ARCHIVE_DIRECTORY = os.path.join(directory, "archives")
+    BOARD_STORE_PATH = os.path.join(directory, "boardstore")
+
+    if snapshot is not None:
+        sidequest_database = load_database_copy(snapshot, BOARD_STORE_PATH)
+    else:
+        sidequest_database = {}
+        init_database(sidequest_database)
+
+    index_users()
+    reconcile_leaderboards()
+    rebuild_expiry_heap()
+
+    bot = StubBot(TOKEN)
+    dispatcher = Dispatcher(bot, None, workers=0, use_context=True)
+    register_handlers(dispatcher)
+
+    start_notification_worker()
+
+    return dispatcher
+
+
+def replay_updates(path, realtime=False, snapshot=None):
+    # Feeds a recorded update log through the handlers, starting from the given snapshot (or an empty database).
+    # Returns (updates replayed, errors, seconds taken, bot calls).
+    dispatcher = start_offline_dispatcher(snapshot)
+
+    errors = []
+    dispatcher.add_error_handler(lambda update, context: errors.append(context.error))
+
+    count = 0
+    first_time = None
+    start = time.time()
+
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            if line.strip() == "":
+                continue
+            record = json.loads(line)
+
+            if realtime:
+                if first_time is None:
+                    first_time = record["time"]
+                delay = (record["time"] - first_time) - (time.time() - start)
+                if delay > 0:
+                    time.sleep(delay)
+
+            dispatcher.process_update(telegram.Update.de_json(record["update"], bot))
+            count += 1
+
+    NOTIFICATION_QUEUE.join()
+
+    return count, errors, time.time() - start, dict(bot.calls)
+
+
+def replay_main(argv):
+    parser = argparse.ArgumentParser(prog="telegram_bot.py replay",
+                                     description="Replay a recorded update log against a stub bot.")
+    parser.add_argument("log", help="Update log recorded with --record.")
+    parser.add_argument("--realtime", action="store_true", help="Keep the original spacing between updates.")
+    parser.add_argument("--from", dest="snapshot", help="Database snapshot to start from instead of an empty one.")
+    parser.add_argument("--expect", help="Database snapshot to compare the final state against.")
+    args = parser.parse_args(argv)
+
+    count, errors, elapsed, calls = replay_updates(args.log, args.realtime, args.snapshot)
+
+    print("Replayed %s updates in %.2fs (%.1f updates/s)." % (count, elapsed, count / elapsed if elapsed > 0 else 0))
+    print("Errors: %s" % len(errors))
+    for name, calls_made in sorted(calls.items()):
+        print("%s: %s" % (name, calls_made))
+
+    if args.expect is not None:
+        expected = load_database_copy(args.expect, os.path.join(tempfile.mkdtemp(prefix="sidequest_expect_"), "boardstore"))
+        differences = diff_databases(sidequest_database, expected)
+        print("Final database matches %s." % args.expect if len(differences) == 0 else "\n".join(differences))
+        return 1 if len(differences) > 0 else 0
+
+    return 0
+
+
+def snapshot_main(argv):
+    parser = argparse.ArgumentParser(prog="telegram_bot.py snapshot",
+                                     description="Show what's in a database snapshot without loading all of it.")
+    parser.add_argument("path", nargs="?", default=DATABASE_PATH)
+    parser.add_argument("--section", help="Print this section as JSON.")
+    args = parser.parse_args(argv)
+
+    if not is_snapshot(args.path):
+        print("%s is an old pickled database (schema version 0); start the bot once to convert it." % args.path)
+        return 0
+
+    reader = SnapshotReader(args.path)
+
+    if args.section is not None:
+        if args.section not in reader.sections:
+            print("No section named %s. Sections: %s" % (args.section, ", ".join(reader.sections)))
+            return 1
+        print(json.dumps(reader.read_json(args.section), ensure_ascii=False, indent=1))
+        return 0
+
+    print("Schema version %s, %s-compressed." % (reader.version, "zstd" if reader.codec == SNAPSHOT_CODEC_ZSTD else "zlib"))
+    for name, (offset, length) in reader.sections.items():
+        print("%s: %s bytes" % (name, length))
+    return 0
+
+
+def export_main(argv):
+    parser = argparse.ArgumentParser(prog="telegram_bot.py export",
+                                     description="Export the last saved database as JSON Lines. Use /export for the live one.")
+    parser.add_argument("path")
+    args = parser.parse_args(argv)
+
+    global sidequest_database
+
+    if not os.path.isfile(DATABASE_PATH):
+        print("There's no database at %s to export." % DATABASE_PATH)
+        return 1
+
+    if not is_snapshot(DATABASE_PATH):
+        print("%s is an old pickled database (schema version 0); start the bot once to convert it." % DATABASE_PATH)
+        return 1
+
+    # A copy with its boards in a temporary BoardStore, so this never writes to the bot's files, even while it runs.
+    sidequest_database = load_database_copy(DATABASE_PATH, os.path.join(tempfile.mkdtemp(prefix="sidequest_export_"), "boardstore"))
+    print("Exported %s records." % export_database(args.path))
+    return 0
+
+
+INSTANCE_LOCK = None
+
+
+def lock_instance():
+    # Returns False if another process already has the database loaded. The lock is held until this process exits
+    # (or execs, on /restart), so an import can't save over a running bot or the other way around.
+    global INSTANCE_LOCK
+    if fcntl is None:
+        return True
+
+    INSTANCE_LOCK = open(INSTANCE_LOCK_PATH, "w")
+    try:
+        fcntl.flock(INSTANCE_LOCK, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        INSTANCE_LOCK.close()
+        INSTANCE_LOCK = None
+        return False
+    return True
+
+
+def check_invariants(telegram_ids=None):
+    # Returns a list of broken invariants. Given telegram_ids, only those people's boards and index entries are
+    # checked, which is cheap enough to do after every update; otherwise everything is.
+    with DATABASE_LOCK:
+        violations = []
+        store = sidequest_database["sidequests"]
+        user_ids = set(id for id, name in sidequest_database["users"])
+
+        if len(user_ids) != len(sidequest_database["users"]):
+            violations.append("users has duplicate ids.")
+
+        if telegram_ids is None:
+            board_ids = list(store.keys())
+            index_ids = user_ids | set(sidequest_database["subscribers"]) | set(sidequest_database["memberships"]) | \
+                        set(sidequest_database["following"]) | set(sidequest_database["followers"]) | set(USER_NAMES) | \
+                        set(sidequest_database["last_seen"])
+        else:
+            board_ids = [id for id in telegram_ids if id in store]
+            index_ids = set(telegram_ids)
+
+        with EXPIRY_LOCK:
+            scheduled = set(questgiver_id for deadline, questgiver_id in EXPIRY_HEAP)
+
+        for questgiver_id in board_ids:
+            board = store.peek(questgiver_id)
+            if len(board) > 0 and questgiver_id not in user_ids:
+                violations.append("Board %s belongs to an unregistered user." % questgiver_id)
+
+            for quest_id, quest in enumerate(board):
+                if len(quest) != 5:
+                    violations.append("Sidequest %s,%s has %s fields." % (questgiver_id, quest_id, len(quest)))
+                    continue
+                if questgiver_id in quest[3]:
+                    violations.append("Sidequest %s,%s was accepted by its own questgiver." % (questgiver_id, quest_id))
+                if len(set(quest[3])) != len(quest[3]):
+                    violations.append("Sidequest %s,%s has duplicate accepters." % (questgiver_id, quest_id))
+                for accepter in quest[3]:
+                    if accepter not in user_ids:
+                        violations.append("Sidequest %s,%s was accepted by unregistered user %s." % (questgiver_id, quest_id, accepter))
+                if quest[4] is not None and not math.isfinite(quest[4]):
+                    violations.append("Sidequest %s,%s has a deadline of %s." % (questgiver_id, quest_id, quest[4]))
+                if quest[4] is not None and questgiver_id not in scheduled:
+                    violations.append("Sidequest %s,%s has a deadline that isn't scheduled." % (questgiver_id, quest_id))
+
+            popularity = sum(len(quest[3]) for quest in board)
+            if POPULARITY_LEADERBOARD.get(questgiver_id) != popularity:
+                violations.append("Popularity of %s is counted as %s but is %s." %
+                                  (questgiver_id, POPULARITY_LEADERBOARD.get(questgiver_id), popularity))
+
+        for telegram_id in index_ids:
+            if telegram_id in sidequest_database["subscribers"] and telegram_id not in user_ids:
+                violations.append("Unregistered user %s is subscribed." % telegram_id)
+            if telegram_id in sidequest_database["last_seen"] and telegram_id not in user_ids:
+                violations.append("Unregistered user %s has a last seen time." % telegram_id)
+            for questgiver_id in sidequest_database["following"].get(telegram_id, ()):
+                if telegram_id not in user_ids or questgiver_id not in user_ids:
+                    violations.append("Follow %s -> %s involves an unregistered user." % (telegram_id, questgiver_id))
+                if telegram_id not in sidequest_database["followers"].get(questgiver_id, ()):
+                    violations.append("Follow %s -> %s is missing from followers." % (telegram_id, questgiver_id))
+            for follower_id in sidequest_database["followers"].get(telegram_id, ()):
+                if telegram_id not in sidequest_database["following"].get(follower_id, ()):
+                    violations.append("Follow %s -> %s is missing from following." % (follower_id, telegram_id))
+
+        for telegram_id in index_ids:
+            if (telegram_id in user_ids) != (telegram_id in USER_NAMES):
+                violations.append("The name index disagrees with users about %s." % telegram_id)
+            for namespace in sidequest_database["memberships"].get(telegram_id, ()):
+                if telegram_id not in user_ids:
+                    violations.append("Unregistered user %s belongs to namespace %s." % (telegram_id, namespace))
+                if telegram_id not in sidequest_database["namespaces"].get(namespace, ()):
+                    violations.append("Membership %s in %s is missing from namespaces." % (telegram_id, namespace))
+
+        namespaces = sidequest_database["namespaces"] if telegram_ids is None else {}
+        for namespace, members in namespaces.items():
+            for telegram_id in members:
+                if namespace not in sidequest_database["memberships"].get(telegram_id, ()):
+                    violations.append("Namespace member %s in %s is missing from memberships." % (telegram_id, namespace))
+
+        # Accepted counts need every board, so they're only checked in full.
+        if telegram_ids is None:
+            accepted, popularity = count_leaderboards()
+            for telegram_id in set(accepted) | set(ACCEPTED_LEADERBOARD.counts):
+                if ACCEPTED_LEADERBOARD.get(telegram_id) != accepted.get(telegram_id, 0):
+                    violations.append("Accepted count of %s is counted as %s but is %s." %
+                                      (telegram_id, ACCEPTED_LEADERBOARD.get(telegram_id), accepted.get(telegram_id, 0)))
+
+            with NAMESPACE_LEADERBOARD_LOCK:
+                for namespace in set(NAMESPACE_LEADERBOARDS) | set(sidequest_database["namespaces"]):
+                    members = sidequest_database["namespaces"].get(namespace, set())
+                    leaderboards = NAMESPACE_LEADERBOARDS.get(namespace, (Leaderboard(), Leaderboard()))
+                    for name, leaderboard, counts in (("Accepted", leaderboards[0], accepted), ("Popularity", leaderboards[1], popularity)):
+                        expected = {id: counts[id] for id in members if counts.get(id, 0) > 0}
+                        if leaderboard.counts != expected:
+                            violations.append("%s leaderboard of namespace %s has %s entries but should have %s." %
+                                              (name, namespace, len(leaderboard.counts), len(expected)))
+
+        return violations
+
+
+def report_violations(violations, source):
+    for violation in violations:
+        ERROR_LOGGER.warning("Invariant violated.", extra={"fields": {"violation": violation, "source": source}})
+
+
+def get_touched_ids(update):
+    # The people whose data an update could have changed: the sender, plus the questgiver for a button press.
+    telegram_ids = set()
+    if update.effective_user is not None:
+        telegram_ids.add(update.effective_user.id)
+    if update.callback_query is not None:
+        split_data = update.callback_query.data.split(",")
+        if len(split_data) > 1 and split_data[1].lstrip("-").isdigit():
+            telegram_ids.add(int(split_data[1]))
+    return telegram_ids
+
+
+def check_update_invariants(update, context):
+    report_violations(check_invariants(get_touched_ids(update)), "update %s" % update.update_id)
+
+
+def make_fake_update(update_id, telegram_id, text=None, callback_data=None, chat_id=None):
+    user = {"id": telegram_id, "is_bot": False, "first_name": "Fuzzer %s" % telegram_id,
+            "username": "thweaver" if telegram_id == ADMIN[0] else None}
+    chat = {"id": telegram_id, "type": "private"} if chat_id is None else {"id": chat_id, "type": "group"}
+
+    if callback_data is not None:
+        message = {"message_id": update_id, "date": int(time.time()), "chat": chat, "text": "Sidequests"}
+        return {"update_id": update_id,
+                "callback_query": {"id": str(update_id), "chat_instance": str(telegram_id), "data": callback_data,
+                                   "from": user, "message": message}}
+
+    message = {"message_id": update_id, "date": int(time.time()), "chat": chat, "from": user, "text": text}
+    if text.startswith("/"):
+        message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split(" ")[0])}]
+    return {"update_id": update_id, "message": message}
+
+
+def make_random_update(rng, update_id, user_ids):
+    telegram_id = rng.choice(user_ids)
+    # Aim button presses at boards that have something on them, or most of them would miss.
+    questgiver_ids = [id for id in user_ids if len(sidequest_database["sidequests"].peek(id)) > 0]
+    other_id = rng.choice(questgiver_ids if len(questgiver_ids) > 0 and rng.random() < 0.8 else user_ids)
+    other_name = "Fuzzer %s" % other_id
+    own_count = len(sidequest_database["sidequests"].peek(telegram_id))
+    other_count = len(sidequest_database["sidequests"].peek(other_id))
+
+    operations = [
+        (8, lambda: ("/am", None)),
+        (1, lambda: ("/rmc", None)),
+        (6, lambda: ("/sidequest", None)),
+        (8, lambda: ("Text %s" % update_id, None)),
+        (3, lambda: (rng.choice(["/skiptitle", "/skipdesc", "/skipreward", "/removetitle", "/removedesc", "/removereward"]), None)),
+        (1, lambda: ("/cancel", None)),
+        (12, lambda: (None, "TOGGLE,%s,%s" % (other_id, rng.randrange(max(other_count, 1))))),
+        (2, lambda: (None, "DELETE,%s,%s" % (telegram_id, rng.randrange(max(own_count, 1))))),
+        (2, lambda: (None, "ARCHIVE,%s,%s" % (telegram_id, rng.randrange(max(own_count, 1))))),
+        (1, lambda: (None, "EDIT,%s,%s" % (telegram_id, rng.randrange(max(own_count, 1))))),
+        (3, lambda: (None, "%s,%s,%s" % (rng.choice(["SHOW", "LIST"]), other_id, rng.randrange(max(other_count, 1))))),
+        (2, lambda: ("/deadline %s %s" % (rng.randrange(max(own_count, 1)) + 1, rng.choice(["0.0001", "1", "off"])), None)),
+        (3, lambda: ("/follow %s" % other_name, None)),
+        (2, lambda: ("/unfollow %s" % other_name, None)),
+        (1, lambda: (rng.choice(["/subscribe", "/unsubscribe", "/mute", "/quiet 22 7", "/quiet off"]), None)),
+        (2, lambda: (rng.choice(["/ms", "/display", "/stats", "/leaderboard"]), None)),
+        (1, lambda: ("/ban %s" % other_name, None) if rng.random() < 0.2 else ("/u", None)),
+        (1, lambda: ("/leave", None)),
+        (1, lambda: (rng.choice(["/bulk ban inactive 0.00001", "/bulk purge unaccepted", "/bulk archive unaccepted",
+                                 "/bulk archive inactive 0.00001"]) if rng.random() < 0.3 else "/u", None)),
+    ]
+
+    pick = rng.uniform(0, sum(weight for weight, operation in operations))
+    for weight, operation in operations:
+        pick -= weight
+        if pick <= 0:
+            break
+    text, callback_data = operation()
+
+    # Bans and bulk operations only go through for the admin.
+    if text is not None and (text.startswith("/ban") or text.startswith("/bulk")):
+        telegram_id = ADMIN[0]
+
+    # Some messages come from group chats, each with its own namespace.
+    chat_id = -rng.randrange(1, 4) if text is not None and rng.random() < 0.3 else None
+
+    return make_fake_update(update_id, telegram_id, text, callback_data, chat_id)
+
+
+def fuzz_database(operations, threads, users, seed):
+    # Fires random updates at the handlers from several threads at once, with the cleanup jobs running alongside,
+    # and checks the invariants after every update. Returns (violations, errors, seconds taken).
+    global DEBUG_INVARIANTS
+    DEBUG_INVARIANTS = False
+
+    dispatcher = start_offline_dispatcher()
+
+    violations = []
+    errors = []
+    dispatcher.add_error_handler(lambda update, context: errors.append(context.error))
+    dispatcher.add_handler(TypeHandler(telegram.Update,
+                                       lambda update, context: violations.extend(check_invariants(get_touched_ids(update)))),
+                           group=1)
+
+    user_ids = [ADMIN[0]] + list(range(1, users))
+    counter = iter(range(1, operations + 1))
+    counter_lock = RLock()
+    done = []
+
+    def worker(worker_seed):
+        rng = random.Random(worker_seed)
+        while True:
+            with counter_lock:
+                update_id = next(counter, None)
+            if update_id is None:
+                return
+            update = make_random_update(rng, update_id, user_ids)
+            dispatcher.process_update(telegram.Update.de_json(update, bot))
+
+    def run_jobs():
+        context = CallbackContext(dispatcher)
+        while len(done) == 0:
+            expire_sidequests_job(context)
+            purge_drafts_job(context)
+            violations.extend(check_invariants())
+            time.sleep(0.01)
+
+    start = time.time()
+
+    job_thread = Thread(target=run_jobs)
+    job_thread.start()
+
+    workers = [Thread(target=worker, args=(seed * 1000 + n,)) for n in range(threads)]
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+
+    done.append(True)
+    job_thread.join()
+    NOTIFICATION_QUEUE.join()
+
+    elapsed = time.time() - start
+    violations.extend(check_invariants())
+
+    return violations, errors, elapsed
+
+
+def fuzz_main(argv):
+    parser = argparse.ArgumentParser(prog="telegram_bot.py fuzz",
+                                     description="Run random operations concurrently and check the database invariants.")
+    parser.add_argument("--operations", type=int, default=5000)
+    parser.add_argument("--threads", type=int, default=8)
+    parser.add_argument("--users", type=int, default=20)
+    parser.add_argument("--seed", type=int, default=int(time.time()))
+    args = parser.parse_args(argv)
+
+    violations, errors, elapsed = fuzz_database(args.operations, args.threads, args.users, args.seed)
+
+    print("Ran %s operations on %s threads in %.2fs (%.1f operations/s), seed %s." %
+          (args.operations, args.threads, elapsed, args.operations / elapsed if elapsed > 0 else 0, args.seed))
+
+    # Handlers answer invalid input with a message, so any exception that reaches the error handler is a crash.
+    # They're grouped by where in this file they were raised.
+    error_counts = defaultdict(int)
+    for error in errors:
+        frames = [frame for frame in traceback.extract_tb(error.__traceback__) if frame.filename == os.path.abspath(__file__)]
+        where = "%s:%s" % (frames[-1].name, frames[-1].lineno) if len(frames) > 0 else "?"
+        error_counts["%s in %s" % (type(error).__name__, where)] += 1
+    print("Handler crashes: %s" % len(errors))
+    for name, count in sorted(error_counts.items(), key=lambda x: -x[1]):
+        print("  %s: %s" % (name, count))
+
+    unique = sorted(set(violations))
+    print("Invariant violations: %s (%s unique)" % (len(violations), len(unique)))
+    for violation in unique[:20]:
+        print("  " + violation)
+
+    return 1 if len(violations) > 0 or len(errors) > 0 else 0
+
+
+def register_handlers(dispatcher):
     # Static commands
 
     static_commands = ["start", "help"]
@@ -893,6 +3129,16 @@ if __name__ == "__main__":
     my_sidequests_aliases = ["mysidequests", "ms"]
     show_all_aliases = ["showall", "sa"]
     archives_aliases = ["archives"]
+    subscribe_aliases = ["subscribe", "sub"]
+    unsubscribe_aliases = ["unsubscribe", "unsub"]
+    follow_aliases = ["follow", "f"]
+    unfollow_aliases = ["unfollow", "uf"]
+    mute_aliases = ["mute"]
+    quiet_hours_aliases = ["quiet", "quiethours"]
+    deadline_aliases = ["deadline", "dl"]
+    leave_aliases = ["leave"]
+    stats_aliases = ["stats"]
+    leaderboard_aliases = ["leaderboard", "lb"]
     #clear_aliases = ["clear"]
 
     commands = [("display", display_aliases),
@@ -903,12 +3149,22 @@ if __name__ == "__main__":
                 ("feedback", feedback_aliases),
                 ("my_sidequests", my_sidequests_aliases),
                 ("show_all", show_all_aliases),
-                ("archives", archives_aliases)
+                ("archives", archives_aliases),
+                ("subscribe", subscribe_aliases),
+                ("unsubscribe", unsubscribe_aliases),
+                ("follow", follow_aliases),
+                ("unfollow", unfollow_aliases),
+                ("mute", mute_aliases),
+                ("quiet_hours", quiet_hours_aliases),
+                ("deadline", deadline_aliases),
+                ("stats", stats_aliases),
+                ("leaderboard", leaderboard_aliases),
+                ("leave", leave_aliases)
                 #("clear", clear_aliases)
                 ]
 
     for base_name, aliases in commands:
-        func = locals()[base_name + "_handler"]
+        func = globals()[base_name + "_handler"]
         dispatcher.add_handler(CommandHandler(aliases, func))
 
     # Special conversation handler for creating/editing a sidequest.
@@ -931,13 +3187,107 @@ if __name__ == "__main__":
                    CommandHandler("removereward", remove_reward_handler)]
         },
 
-        fallbacks=[CommandHandler("cancel", cancel_handler)]
+        fallbacks=[CommandHandler("cancel", cancel_handler)],
+
+        name="sidequest_editor",
+        persistent=dispatcher.persistence is not None
     ))
 
     # Button handler
 
     dispatcher.add_handler(CallbackQueryHandler(button_handler))
 
+    # Ban
+
+    dispatcher.add_handler(CommandHandler("ban", ban_handler, pass_args=True, filters=Filters.user(username='@thweaver')))
+
+    # Bulk import/export
+
+    # These are slow, so they run on a worker thread. Replays and the fuzzer use a dispatcher without workers,
+    # where run_async callbacks would be queued and never run, so there they run inline.
+    run_async = dispatcher.workers > 0
+
+    dispatcher.add_handler(CommandHandler("export", export_handler, run_async=run_async))
+    dispatcher.add_handler(CommandHandler("import", import_handler, run_async=run_async))
+
+    # Bulk admin operations
+
+    dispatcher.add_handler(CommandHandler("bulk", bulk_handler, run_async=run_async))
+
+    # Keep track of when everyone last used the bot. This runs after every other handler, so someone who just
+    # removed themselves isn't recorded again.
+
+    dispatcher.add_handler(TypeHandler(telegram.Update, touch_last_seen), group=2)
+
+
+if __name__ == "__main__":
+    # Command line tools that don't run the bot:
+    # python telegram_bot.py export {path}
+    # python telegram_bot.py import {path} (only while the bot isn't running; use /import otherwise)
+    # python telegram_bot.py replay {update log} [--realtime] [--from snapshot] [--expect snapshot]
+    # python telegram_bot.py fuzz [--operations n] [--threads n] [--users n] [--seed n]
+    # python telegram_bot.py snapshot [path] [--section name]
+
+    if len(sys.argv) > 1 and sys.argv[1] == "replay":
+        sys.exit(replay_main(sys.argv[2:]))
+
+    if len(sys.argv) > 1 and sys.argv[1] == "fuzz":
+        sys.exit(fuzz_main(sys.argv[2:]))
+
+    if len(sys.argv) > 1 and sys.argv[1] == "snapshot":
+        sys.exit(snapshot_main(sys.argv[2:]))
+
+    if len(sys.argv) > 1 and sys.argv[1] == "export":
+        sys.exit(export_main(sys.argv[2:]))
+
+    # Init setup
+
+    if not lock_instance():
+        if len(sys.argv) > 1 and sys.argv[1] == "import":
+            print("The bot is running, so importing here would be lost at its next save. Use /import instead.")
+        else:
+            print("The bot (or an import) is already running against %s." % DATABASE_PATH)
+        sys.exit(1)
+
+    if os.path.isfile(DATABASE_PATH):
+        sidequest_database, DATABASE_VERSION = load_database(DATABASE_PATH)
+
+    if init_database(sidequest_database, DATABASE_VERSION):
+        save_database(None)
+
+    index_users()
+
+    if len(sys.argv) == 3 and sys.argv[1] == "import":
+        try:
+            print("Imported %s records." % import_database(sys.argv[2]))
+        except (ValueError, KeyError, TypeError) as e:
+            save_database(None)
+            print("The import stopped partway through, keeping what came before: %s" % e)
+            sys.exit(1)
+        save_database(None)
+        sys.exit(0)
+
+    PERSISTENCE = PicklePersistence(filename=CONVERSATION_STATE_PATH,
+                                    store_user_data=True,
+                                    store_chat_data=False,
+                                    store_bot_data=False,
+                                    on_flush=True)
+
+    updater = Updater(token=TOKEN, use_context=True, persistence=PERSISTENCE)
+    dispatcher = updater.dispatcher
+
+    # Record every update before any other handler sees it.
+
+    if RECORD_UPDATES:
+        dispatcher.add_handler(TypeHandler(telegram.Update, record_update), group=-1)
+
+    register_handlers(dispatcher)
+
+    # In debug mode, check whatever each update touched once every other handler is done with it.
+
+    if DEBUG_INVARIANTS:
+        dispatcher.add_handler(TypeHandler(telegram.Update, check_update_invariants), group=1)
+
     # Set up job queue for repeating automatic tasks.
 
     jobs = updater.job_queue
@@ -945,6 +3295,18 @@ if __name__ == "__main__":
     save_database_job = jobs.run_repeating(save_database, interval=3600, first=0)
     save_database_job.enabled = True
 
+    rebuild_expiry_heap()
+    reconcile_leaderboards()
+
+    violations = check_invariants()
+    report_violations(violations, "startup")
+    if len(violations) > 0:
+        print("Found %s invariant violations on startup; see error_logs.log." % len(violations))
+
+    jobs.run_repeating(reconcile_leaderboards_job, interval=RECONCILE_SECONDS, first=RECONCILE_SECONDS)
+    jobs.run_repeating(expire_sidequests_job, interval=EXPIRY_CHECK_SECONDS, first=EXPIRY_CHECK_SECONDS)
+    jobs.run_repeating(purge_drafts_job, interval=DRAFT_PURGE_SECONDS, first=DRAFT_PURGE_SECONDS)
+
     # Error handler
 
     dispatcher.add_error_handler(handle_error)
@@ -952,11 +3314,15 @@ if __name__ == "__main__":
     # Restart
 
     def stop_and_restart():
+        # Save after the updater has stopped, so no update can move an editor past the saved boards.
         updater.stop()
+        save_database(None)
+        drain_notifications(NOTIFICATION_DRAIN_SECONDS)
+        # execl replaces the process without running atexit, so flush the log queues here.
+        stop_loggers()
         os.execl(sys.executable, sys.executable, *sys.argv)
 
     def restart(update, context):
-        save_database(context)
         update.message.reply_text('Bot is restarting...')
         Thread(target=stop_and_restart).start()
 
@@ -964,13 +3330,23 @@ if __name__ == "__main__":
                                           restart,
                                           filters=Filters.user(username='@thweaver')))
 
-    # Ban
-
-    dispatcher.add_handler(CommandHandler("ban", ban_handler, pass_args=True, filters=Filters.user(username='@thweaver')))
-
     # Run the bot
 
     #send_patchnotes()
 
+    # PTB's own signal handler only flushes the editor state, which could then point past the end of boards
+    # from the last hourly save. Stop taking updates first, then save both together.
+
+    def shutdown(signum, frame):
+        updater.stop()
+        save_database(None)
+        drain_notifications(NOTIFICATION_DRAIN_SECONDS)
+        updater.is_idle = False
+
+    for stop_signal in (signal.SIGINT, signal.SIGTERM, signal.SIGABRT):
+        signal.signal(stop_signal, shutdown)
+
+    start_notification_worker()
+
     updater.start_polling()
-    updater.idle()
+    updater.idle(stop_signals=())